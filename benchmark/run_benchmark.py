@@ -0,0 +1,357 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import sqlite3
+import argparse
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from colorama import init, Fore, Style
+
+import stub_server
+
+# fix colorama colors in windows console
+init(convert=True)
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+downloader_script = os.path.join(repo_folder, 'wmts-downloader.py')
+combine_script = os.path.join(repo_folder, 'combine-ign.py')
+cards_file = os.path.join(repo_folder, 'cartas.geojson')
+
+# combine-ign.py only reads this layer and zoom level
+layer = 'cartas_50k'
+zoom = 15
+
+cards = 4
+format = 'image/png'
+latency = 0
+error_rate = 0
+blank_ratio = 0.1
+workers = 8
+rate = 1000
+store = 'files'
+processes = 1
+split = 'lease'
+jobs = 1
+results_file = 'benchmark-results.jsonl'
+
+parser = argparse.ArgumentParser(description='Runs wmts-downloader.py and combine-ign.py end to end against a local stub WMTS server, and appends the results to a JSON lines file')
+parser.add_argument('--label', type=str, metavar='Label', default=None, help='Name saved with the results, e.g. a branch name (default: %(default)s)')
+parser.add_argument('--cards', type=int, metavar='Cards number', default=cards, help='Number of cards of cartas.geojson whose tiles are downloaded and combined (default: %(default)s)')
+parser.add_argument('--format', type=str, metavar='Image format', choices=['image/png', 'image/jpeg'], default=format, help='Format of the synthetic tiles (default: %(default)s)')
+parser.add_argument('--latency', type=float, metavar='Seconds', default=latency, help='Latency of the stub server for each tile (default: %(default)s)')
+parser.add_argument('--error-rate', type=float, metavar='Ratio', default=error_rate, help='Share of the tile requests answered with 429 or 503 (default: %(default)s)')
+parser.add_argument('--blank-ratio', type=float, metavar='Ratio', default=blank_ratio, help='Share of blank tiles (default: %(default)s)')
+parser.add_argument('--workers', type=int, metavar='Workers number', default=workers, help='Workers of the downloader (default: %(default)s)')
+parser.add_argument('--rate', type=float, metavar='Requests per second', default=rate, help='Initial rate of the downloader (default: %(default)s)')
+parser.add_argument('--store', type=str, metavar='Output store', choices=['files', 'mbtiles', 'gpkg', 'cog'], default=store, help='Store of the downloader, combine-ign.py is only run for `files` (default: %(default)s)')
+parser.add_argument('--processes', type=int, metavar='Processes number', default=processes, help='Downloader processes run at the same time on the same output, each one with its own workers (default: %(default)s)')
+parser.add_argument('--split', type=str, metavar='Split', choices=['shard', 'lease'], default=split, help='How the processes share the job, with `--shard i/N` or `--lease` (default: %(default)s)')
+parser.add_argument('--jobs', type=int, metavar='Processes number', default=jobs, help='Processes of combine-ign.py (default: %(default)s)')
+parser.add_argument('--skip-combine', action='store_true', help='Only run the downloader (default: %(default)s)')
+parser.add_argument('--results', type=str, metavar='JSON lines file', default=results_file, help='File the results are appended to (default: %(default)s)')
+parser.add_argument('--work', type=str, metavar='Folder', default=None, help='Folder for the tiles and outputs, kept after the run. A temporary folder is used and removed by default')
+
+
+def init():
+    args = parser.parse_args()
+
+    if args.processes > 1 and args.store == 'cog':
+        parser.error('the `cog` store can\'t be written by several processes')
+
+    work_folder = args.work or tempfile.mkdtemp(prefix='wmts-benchmark-')
+    os.makedirs(work_folder, exist_ok=True)
+
+    parameters = {key: value for (key, value) in vars(args).items() if key not in ('label', 'results', 'work')}
+
+    print('--> BENCHMARK STARTED <--')
+    print(f'-> Work folder: {work_folder}')
+
+    server = stub_server.serve(layer=layer, format=args.format, latency=args.latency, error_rate=args.error_rate, blank_ratio=args.blank_ratio)
+
+    try:
+        # the cards are both the area to download and the sheets to combine
+        with open(cards_file) as file:
+            collection = json.load(file)
+
+        collection['features'] = collection['features'][:args.cards]
+
+        with open(os.path.join(work_folder, 'cartas.geojson'), 'w') as file:
+            json.dump(collection, file)
+
+        print(f'-> Stub server: http://{server.host}/wmts')
+        print(f'-> Running wmts-downloader.py{f" in {args.processes} processes" if args.processes > 1 else ""}...')
+
+        arguments = [
+            downloader_script, f'http://{server.host}/wmts',
+            '--layer', layer,
+            '--zoom', str(zoom),
+            '--format', args.format,
+            '--aoi', 'cartas.geojson',
+            '--workers', str(args.workers),
+            '--rate', str(args.rate),
+            '--store', args.store,
+            '--retries', '10'
+        ]
+
+        if args.processes > 1:
+            download = run_processes(work_folder, 'download', [
+                arguments + (['--shard', f'{index + 1}/{args.processes}'] if args.split == 'shard' else ['--lease'])
+                for index in range(args.processes)
+            ])
+        else:
+            download = run_script(work_folder, 'download', arguments)
+
+        counters = download['metrics'].get('counters', {})
+        download['tiles'] = counters.get('tiles_downloaded', 0)
+        download['tiles_per_second'] = round(download['tiles'] / download['seconds'], 3)
+        download['bytes_per_second'] = round(counters.get('bytes', 0) / download['seconds'], 3)
+        download.update(count_files(os.path.join(work_folder, 'output', layer)))
+
+        print(f'{Fore.GREEN}-> Downloaded {download["tiles"]} tiles in {download["seconds"]:.1f}s ({download["tiles_per_second"]:.1f} tiles/s){Style.RESET_ALL}')
+
+        # every planned tile done once, whatever the number of processes
+        download['check'] = check_download(work_folder, args.store, download['output'])
+
+        check = download['check']
+        color = Fore.GREEN if not check['missing'] and not check['repeated'] else Fore.RED
+
+        print(f'{color}-> Tiles done: {check["done"]}/{check["planned"]} ({check["missing"]} missing, {check["failed"]} failed), tiles served more than once: {check["repeated"]}{Style.RESET_ALL}')
+
+        results = {
+            'label': args.label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': parameters,
+            'server': dict(stub_server.stats),
+            'download': download
+        }
+
+        if not args.skip_combine and args.store == 'files':
+            print('-> Running combine-ign.py...')
+
+            combine = run_script(work_folder, 'combine', [combine_script, '--jobs', str(args.jobs)])
+            combine['sheets'] = get_sheets_seconds(combine.pop('output'))
+            combine.update(count_files(os.path.join(work_folder, 'output', 'merged')))
+
+            print(f'{Fore.GREEN}-> Combined {len(combine["sheets"])} sheets in {combine["seconds"]:.1f}s{Style.RESET_ALL}')
+
+            results['combine'] = combine
+
+        download.pop('output')
+
+        compare_results(args.results, results)
+
+        with open(args.results, 'a') as file:
+            file.write(json.dumps(results) + '\n')
+
+        print(f'-> Results appended to {args.results}')
+        print('--> BENCHMARK COMPLETED <--')
+
+    finally:
+        server.shutdown()
+
+        if not args.work:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def run_script(work_folder, name, arguments):
+    '''
+    Runs a script in the work folder with its metrics log, and returns its time, peak memory,
+    exit code, output and last metrics. The peak memory is only measured where `os.wait4` exists
+    '''
+
+    metrics_path = os.path.join(work_folder, f'{name}-metrics.jsonl')
+
+    command = [sys.executable, *arguments, '--metrics-log', metrics_path, '--metrics-interval', '1']
+
+    start = time.perf_counter()
+
+    process = subprocess.Popen(command, cwd=work_folder, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read().decode(errors='replace')
+
+    peak_rss_mb = None
+
+    if hasattr(os, 'wait4'):
+        (_, status, usage) = os.wait4(process.pid, 0)
+        exit_code = os.waitstatus_to_exitcode(status)
+
+        # kilobytes in linux, bytes in macos
+        peak_rss_mb = round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+        process.returncode = exit_code
+    else:
+        exit_code = process.wait()
+
+    seconds = time.perf_counter() - start
+
+    with open(os.path.join(work_folder, f'{name}.log'), 'w') as file:
+        file.write(output)
+
+    # the scripts print their errors instead of failing
+    if exit_code or 'Traceback' in output:
+        print(f'{Fore.RED}-> {os.path.basename(arguments[0])} failed, see {name}.log{Style.RESET_ALL}')
+
+    return {
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': peak_rss_mb,
+        'exit_code': exit_code,
+        'errors': 'Traceback' in output,
+        'metrics': read_last_line(metrics_path),
+        'output': output
+    }
+
+
+def run_processes(work_folder, name, arguments_list):
+    '''
+    Runs several processes of a script at the same time, and returns their results merged as a
+    single run: the total time, the highest peak memory and the sum of the counters. The results
+    of each process are kept in `processes`
+    '''
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=len(arguments_list)) as executor:
+        runs = list(executor.map(lambda item: run_script(work_folder, f'{name}-{item[0] + 1}', item[1]), enumerate(arguments_list)))
+
+    seconds = time.perf_counter() - start
+
+    counters = collections.Counter()
+    for run in runs:
+        counters.update(run['metrics'].get('counters', {}))
+
+    peak_rss = [run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None]
+
+    return {
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': max(peak_rss) if peak_rss else None,
+        'exit_code': next((run['exit_code'] for run in runs if run['exit_code']), 0),
+        'errors': any(run['errors'] for run in runs),
+        'metrics': {'counters': dict(counters)},
+        'output': '\n'.join(run['output'] for run in runs),
+        'processes': [{key: value for (key, value) in run.items() if key != 'output'} for run in runs]
+    }
+
+
+def check_download(work_folder, store, output):
+    '''
+    Compares the tiles planned with the ones done in the manifest, and counts the tiles
+    the stub server sent more than once (the throttled requests are not counted)
+    '''
+
+    # printed by every process, for the whole job
+    planned = 0
+    for line in output.splitlines():
+        if line.startswith('-> Total tiles in layer: '):
+            planned = int(line.rsplit(' ', 1)[1])
+
+    manifest_name = 'manifest' if store == 'files' else f'manifest-{store}'
+    manifest_path = os.path.join(work_folder, 'output', layer, 'EPSG-3857', f'{manifest_name}.sqlite')
+
+    status = {}
+
+    if os.path.exists(manifest_path):
+        connection = sqlite3.connect(manifest_path)
+        try:
+            status = dict(connection.execute('SELECT status, COUNT(*) FROM tiles WHERE layer = ? AND zoom = ? GROUP BY status', (layer, zoom)))
+        finally:
+            connection.close()
+
+    done = status.get('done', 0) + status.get('skipped', 0)
+
+    return {
+        'planned': planned,
+        'done': done,
+        'failed': status.get('failed', 0),
+        'missing': max(0, planned - done),
+        'repeated': stub_server.stats['tiles_repeated']
+    }
+
+
+def read_last_line(path):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        lines = file.read().splitlines()
+
+    return json.loads(lines[-1]) if lines else {}
+
+
+def count_files(folder):
+    files = 0
+    size = 0
+
+    for (root, _, names) in os.walk(folder):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+
+    return {'files': files, 'files_bytes': size}
+
+
+def get_sheets_seconds(output):
+    '''
+    Conversion time of each sheet, from the lines printed by combine-ign.py
+    '''
+
+    sheets = {}
+
+    for line in output.splitlines():
+        if line.startswith('-> Conversion Nº') and ' finished in ' in line:
+            (name, seconds) = line.split(' - ', 1)[1].rsplit(' finished in ', 1)
+            sheets[name] = float(seconds.rstrip('s'))
+
+    return sheets
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_folder, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare_results(path, results):
+    '''
+    Prints the change against the last run with the same parameters in the results file
+    '''
+
+    if not os.path.exists(path):
+        return
+
+    previous = None
+
+    with open(path) as file:
+        for line in file:
+            run = json.loads(line)
+            if run.get('parameters') == results['parameters']:
+                previous = run
+
+    if not previous:
+        return
+
+    print(f'-> Compared with {previous["label"] or previous["commit"]} ({previous["time"]}):')
+
+    comparisons = [('download', 'tiles_per_second', True), ('download', 'peak_rss_mb', False), ('combine', 'seconds', False), ('combine', 'peak_rss_mb', False)]
+
+    for (step, key, higher_is_better) in comparisons:
+        before = previous.get(step, {}).get(key)
+        after = results.get(step, {}).get(key)
+
+        if not before or after is None:
+            continue
+
+        change = after / before - 1
+        color = Fore.GREEN if (change >= 0) == higher_is_better else Fore.RED
+
+        print(f'{color}--> {step} {key}: {before} -> {after} ({change:+.1%}){Style.RESET_ALL}')
+
+
+if __name__ == '__main__':
+    init()
@@ -0,0 +1,355 @@
+import json
+import time
+import zlib
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# EPSG:3857 (GoogleMapsCompatible) tile matrix set
+origin = 20037508.342789244
+scale_denominator = 559082264.0287178
+
+# area with content, in EPSG:3857, the tiles outside it are blank
+coverage = (-8200000, -7400000, -5900000, -2400000)
+
+port = 8765
+layer = 'cartas_50k'
+format = 'image/png'
+latency = 0
+error_rate = 0
+blank_ratio = 0
+max_zoom = 18
+
+# requests served, read by the benchmark or at `/stats`
+stats = {'connections': 0, 'requests': 0, 'tiles': 0, 'tiles_served': 0, 'tiles_repeated': 0, 'status': {}}
+stats_lock = threading.Lock()
+
+# (zoom, row, col) of the tiles sent, to find the ones requested again after being served
+served_tiles = set()
+
+parser = argparse.ArgumentParser(description='Local WMTS stand-in serving synthetic tiles, to benchmark the scripts without a real server')
+parser.add_argument('--port', type=int, metavar='Port', default=port, help='Port to listen on (default: %(default)s)')
+parser.add_argument('--layer', type=str, metavar='Layer name', default=layer, help='Layer name (default: %(default)s)')
+parser.add_argument('--format', type=str, metavar='Image format', choices=['image/png', 'image/jpeg'], default=format, help='Format of the tiles, JPEG requires rasterio (default: %(default)s)')
+parser.add_argument('--latency', type=float, metavar='Seconds', default=latency, help='Time waited before answering each tile (default: %(default)s)')
+parser.add_argument('--error-rate', type=float, metavar='Ratio', default=error_rate, help='Share of the tile requests answered with 429 or 503 (default: %(default)s)')
+parser.add_argument('--blank-ratio', type=float, metavar='Ratio', default=blank_ratio, help='Share of the tiles inside the coverage that are fully transparent (default: %(default)s)')
+
+
+def count(key, status=None):
+    with stats_lock:
+        stats[key] += 1
+        if status is not None:
+            stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+
+
+def count_served(zoom, row, col):
+    with stats_lock:
+        stats['tiles_served'] += 1
+        if (zoom, row, col) in served_tiles:
+            stats['tiles_repeated'] += 1
+        else:
+            served_tiles.add((zoom, row, col))
+
+
+def get_tiles_range(zoom, extent):
+    span = 2 * origin / 2 ** zoom
+
+    min_col = int((extent[0] + origin) // span)
+    max_col = int((extent[2] + origin) // span)
+    min_row = int((origin - extent[3]) // span)
+    max_row = int((origin - extent[1]) // span)
+
+    return (min_row, max_row, min_col, max_col)
+
+
+def get_capabilities(host, layer, format, max_zoom):
+    '''
+    Capabilities of a single layer with the EPSG:3857 tile matrix set, limited to the coverage
+    '''
+
+    extension = format.split('/')[-1]
+    matrices = []
+    limits = []
+
+    for zoom in range(max_zoom + 1):
+        matrices.append(f'''
+      <TileMatrix>
+        <ows:Identifier>EPSG:3857:{zoom}</ows:Identifier>
+        <ScaleDenominator>{scale_denominator / 2 ** zoom!r}</ScaleDenominator>
+        <TopLeftCorner>{-origin!r} {origin!r}</TopLeftCorner>
+        <TileWidth>256</TileWidth>
+        <TileHeight>256</TileHeight>
+        <MatrixWidth>{2 ** zoom}</MatrixWidth>
+        <MatrixHeight>{2 ** zoom}</MatrixHeight>
+      </TileMatrix>''')
+
+        (min_row, max_row, min_col, max_col) = get_tiles_range(zoom, coverage)
+
+        limits.append(f'''
+          <TileMatrixLimits>
+            <TileMatrix>EPSG:3857:{zoom}</TileMatrix>
+            <MinTileRow>{min_row}</MinTileRow>
+            <MaxTileRow>{max_row}</MaxTileRow>
+            <MinTileCol>{min_col}</MinTileCol>
+            <MaxTileCol>{max_col}</MaxTileCol>
+          </TileMatrixLimits>''')
+
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Stub WMTS</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+    <ows:AccessConstraints>none</ows:AccessConstraints>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="http://{host}/wmts?"><ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint></ows:Get></ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetTile">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="http://{host}/wmts?"><ows:Constraint name="GetEncoding"><ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint></ows:Get></ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>
+    <Layer>
+      <ows:Title>{layer}</ows:Title>
+      <ows:Abstract>Synthetic tiles</ows:Abstract>
+      <ows:WGS84BoundingBox>
+        <ows:LowerCorner>-73.6 -55.1</ows:LowerCorner>
+        <ows:UpperCorner>-53.0 -21.7</ows:UpperCorner>
+      </ows:WGS84BoundingBox>
+      <ows:Identifier>{layer}</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style>
+      <Format>{format}</Format>
+      <TileMatrixSetLink>
+        <TileMatrixSet>EPSG:3857</TileMatrixSet>
+        <TileMatrixSetLimits>{''.join(limits)}
+        </TileMatrixSetLimits>
+      </TileMatrixSetLink>
+      <ResourceURL format="{format}" resourceType="tile" template="http://{host}/wmts/rest/{layer}/{{Style}}/{{TileMatrixSet}}/{{TileMatrix}}/{{TileRow}}/{{TileCol}}.{extension}"/>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>EPSG:3857</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>{''.join(matrices)}
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>'''
+
+
+def encode_png(width, height, pixels, level=1):
+    '''
+    Encodes RGBA bytes as a PNG, without any imaging library
+    '''
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+
+    stride = width * 4
+    raw = b''.join(b'\x00' + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, level)) + chunk(b'IEND', b'')
+
+
+def encode_jpeg(width, height, pixels):
+    import numpy as np
+    from rasterio.io import MemoryFile
+
+    array = np.frombuffer(pixels, dtype='uint8').reshape(height, width, 4).transpose(2, 0, 1)[:3]
+
+    with MemoryFile() as memfile:
+        with memfile.open(driver='JPEG', width=width, height=height, count=3, dtype='uint8') as dst:
+            dst.write(array)
+        return memfile.read()
+
+
+class TileFactory:
+    '''
+    Builds the synthetic tiles. They are the same on every run: the tiles outside the coverage,
+    and a share of the ones inside chosen by a hash of their position, are blank, and the others
+    have their position stamped so each one is different
+    '''
+
+    def __init__(self, format, blank_ratio, size=256):
+        self.format = format
+        self.blank_ratio = blank_ratio
+        self.size = size
+
+        pixels = bytes(size * size * 4)
+        self.blank = encode_png(size, size, pixels, 9) if format == 'image/png' else encode_jpeg(size, size, pixels)
+
+        # a gradient, so the tiles compress like an image and not like a flat color
+        self.base = bytearray(bytes(range(256)) * (size * 4 // 256) * size)
+
+    def is_blank(self, zoom, row, col):
+        span = 2 * origin / 2 ** zoom
+        left = col * span - origin
+        top = origin - row * span
+
+        if left > coverage[2] or left + span < coverage[0] or top < coverage[1] or top - span > coverage[3]:
+            return True
+
+        seed = int(hashlib.md5(f'{zoom}/{row}/{col}'.encode()).hexdigest()[:8], 16)
+
+        return seed / 0xffffffff < self.blank_ratio
+
+    def get_tile(self, zoom, row, col):
+        if self.is_blank(zoom, row, col):
+            return self.blank
+
+        pixels = self.base[:]
+
+        # the position every 16 rows, only in the color bytes as the alpha is set below
+        stamp = struct.pack('>III', zoom, row, col)
+        for y in range(0, self.size, 16):
+            offset = y * self.size * 4
+            for (index, value) in enumerate(stamp):
+                pixels[offset + index + index // 3] = value
+
+        pixels[3::4] = b'\xff' * (self.size * self.size)
+
+        if self.format == 'image/png':
+            return encode_png(self.size, self.size, bytes(pixels))
+
+        return encode_jpeg(self.size, self.size, bytes(pixels))
+
+
+class StubServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, layer=layer, format=format, latency=latency, error_rate=error_rate, blank_ratio=blank_ratio, max_zoom=max_zoom, seed=0):
+        super().__init__(address, StubHandler)
+        self.layer = layer
+        self.format = format
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_zoom = max_zoom
+        self.random = random.Random(seed)
+        self.tiles = TileFactory(format, blank_ratio)
+
+    @property
+    def host(self):
+        return f'{self.server_address[0]}:{self.server_address[1]}'
+
+    def process_request(self, request, client_address):
+        count('connections')
+        super().process_request(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the KVP and RESTful GetTile requests, the GetCapabilities and `/stats`.
+    Tiles and capabilities have an ETag, so conditional requests get a 304
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body=b'', content_type='text/plain', headers=None):
+        count('requests', status)
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+
+        if url.path == '/stats':
+            with stats_lock:
+                body = json.dumps(stats).encode()
+            return self.send_body(200, body, 'application/json')
+
+        if url.path.startswith('/wmts/rest/'):
+            parts = unquote(url.path)[len('/wmts/rest/'):].rsplit('.', 1)[0].split('/')
+            if len(parts) != 6:
+                return self.send_body(400)
+            (layer, _, tile_matrix_set, tile_matrix, row, col) = parts
+            return self.send_tile(layer, tile_matrix_set, tile_matrix, row, col)
+
+        if url.path == '/wmts':
+            query = {key.upper(): value[0] for (key, value) in parse_qs(url.query).items()}
+            request = query.get('REQUEST', '').lower()
+
+            if request == 'getcapabilities':
+                body = get_capabilities(server.host, server.layer, server.format, server.max_zoom).encode()
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send_body(304, headers={'ETag': etag})
+                return self.send_body(200, body, 'application/xml', {'ETag': etag})
+
+            if request == 'gettile':
+                return self.send_tile(query.get('LAYER'), query.get('TILEMATRIXSET'), query.get('TILEMATRIX'),
+                                      query.get('TILEROW'), query.get('TILECOL'))
+
+        self.send_body(404)
+
+    def send_tile(self, layer, tile_matrix_set, tile_matrix, row, col):
+        server = self.server
+        count('tiles')
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.error_rate and server.random.random() < server.error_rate:
+            return self.send_body(429 if server.random.random() < 0.5 else 503, headers={'Retry-After': '1'})
+
+        if layer != server.layer or tile_matrix_set != 'EPSG:3857':
+            return self.send_body(400)
+
+        try:
+            zoom = int(tile_matrix.split(':')[-1])
+            row = int(row)
+            col = int(col)
+        except (AttributeError, ValueError):
+            return self.send_body(400)
+
+        if zoom > server.max_zoom or not (0 <= row < 2 ** zoom and 0 <= col < 2 ** zoom):
+            return self.send_body(400)
+
+        body = server.tiles.get_tile(zoom, row, col)
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_body(304, headers={'ETag': etag})
+
+        count_served(zoom, row, col)
+
+        self.send_body(200, body, server.format, {'ETag': etag, 'Last-Modified': 'Mon, 03 Oct 2022 00:00:00 GMT'})
+
+
+def serve(port=0, **kwargs):
+    '''
+    Starts a server in a background thread, in a free port by default, and returns it
+    '''
+
+    server = StubServer(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, name='stub-server', daemon=True).start()
+
+    return server
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    server = StubServer(('127.0.0.1', args.port), args.layer, args.format, args.latency, args.error_rate, args.blank_ratio)
+
+    print(f'Serving a stub WMTS at http://{server.host}/wmts')
+
+    server.serve_forever()
@@ -1,17 +1,11 @@
-import os
-import time
-import math
-import shutil
-import tempfile
 import argparse
 import traceback
 from colorama import init, Fore, Style
-from owslib.wmts import WebMapTileService
+from wmts_downloader import download_layer, metrics, run_profiled
 
 # fix colorama colors in windows console
 init(convert=True)
 
-tmp_folder = f'{tempfile.gettempdir()}\\wmts-downloader'
 output_folder = 'output'
 
 zoom = 15
@@ -20,26 +14,60 @@ url = ''
 proj = 'EPSG:3857'
 limit_requests = 0
 bbox = None
+aoi = None
+order = 'row'
+workers = 1
+pool_size = None # defaults to the number of workers
+timeout = 30
+store = 'files'
 
 sleep = 0 # sleep time between request
+rate = 10 # initial requests per second, adjusted while downloading
+max_rate = 0
+max_retries = 5
+capabilities_ttl = 86400 # seconds the cached capabilities are used without asking the server
+shard = None
+lease_size = 32 # side of the blocks of tiles leased by each process
+lease_ttl = 60 # seconds a lease lasts without a heartbeat
+
+metrics_interval = 10 # seconds between the lines of the metrics log
 
 parser = argparse.ArgumentParser(description='Script to download images from a WMTS service')
 parser.add_argument('url', type=str, metavar='WMTS server url', help='Server url (default: %(default)s)')
 parser.add_argument('--layer', type=str, metavar='Layer name', required=True, help='Layer name (default: %(default)s)')
 parser.add_argument('--format', type=str, metavar='Image format', default=format, help='Image format supported by the geoserver (default: %(default)s)')
 parser.add_argument('--zoom', type=int, metavar='Zoom level', default=zoom, help='Zoom level. Higher number is more detail, and more images (default: %(default)s)')
+parser.add_argument('--zoom-range', type=str, metavar='Zoom levels range', default=None, help='Download every zoom level between two levels, e.g. `10-15`, instead of `zoom` (default: %(default)s)')
+parser.add_argument('--skip-empty', action='store_true', help='Don\'t request the tiles whose parent tile, in the previous zoom level, was blank (fully transparent). Requires rasterio (default: %(default)s)')
 parser.add_argument('--proj', type=str, metavar='EPSG projection code', default=proj, help='EPSG projection code existing in the geoserver (default: %(default)s)')
 parser.add_argument('--output', type=str, metavar='Output folder', default=output_folder, help='Folder path to save the images (default: %(default)s)')
 parser.add_argument('--limit', type=int, metavar='Limit requests number', default=limit_requests, help='Limit the number of requests to avoid overloading the server (default: %(default)s)')
 parser.add_argument('--removeold', action='store_true', help='Remove already downloaded files (default: %(default)s)')
-parser.add_argument('--sleep', type=float, metavar='Sleep time', default=sleep, help='Sleep time (in seconds) betweeen each reques to avoid overloading the server (default: %(default)s)')
+parser.add_argument('--refresh', action='store_true', help='Check the downloaded tiles for changes with conditional requests (ETag / Last-Modified), and save again only the ones that changed (default: %(default)s)')
+parser.add_argument('--sleep', type=float, metavar='Sleep time', default=sleep, help='Minimum time (in seconds) betweeen each request to avoid overloading the server. Same as `--max-rate 1/sleep` (default: %(default)s)')
+parser.add_argument('--rate', type=float, metavar='Requests per second', default=rate, help='Initial requests per second. The rate increases while the server answers fast and backs off when it is overloaded (default: %(default)s)')
+parser.add_argument('--max-rate', type=float, metavar='Max requests per second', default=max_rate, help='Upper limit for the requests per second, 0 for no limit (default: %(default)s)')
+parser.add_argument('--retries', type=int, metavar='Retries number', default=max_retries, help='Times a failed tile is retried before giving up on it (default: %(default)s)')
 parser.add_argument('--bbox', type=str, metavar='Bounding Box', nargs='+', default=bbox, help='Bounding Box of interest to filter the requests. Separate each value with a space (default: %(default)s)')
-
-args = parser.parse_args()
-
-def init():
-
-    global output_folder
+parser.add_argument('--aoi', type=str, metavar='GeoJSON file', default=aoi, help='Only download the tiles intersecting the polygons of a GeoJSON file, e.g. cartas.geojson. Combined with `bbox` if both are used (default: %(default)s)')
+parser.add_argument('--order', type=str, metavar='Tiles order', choices=['row', 'hilbert'], default=order, help='Order in which the tiles are requested: row by row (`row`), or following a Hilbert curve so close tiles are requested together (`hilbert`) (default: %(default)s)')
+parser.add_argument('--workers', type=int, metavar='Workers number', default=workers, help='Number of tiles requested concurrently. `limit` and `sleep` are applied globally, not per worker (default: %(default)s)')
+parser.add_argument('--pool', type=int, metavar='Connection pool size', default=pool_size, help='Number of keep-alive connections shared by the workers. Defaults to the number of workers (default: %(default)s)')
+parser.add_argument('--store', type=str, metavar='Output store', choices=['files', 'mbtiles', 'gpkg', 'cog'], default=store, help='Where the tiles are saved: one image and world file per tile (`files`), a single MBTiles or GeoPackage file per layer (`mbtiles`, `gpkg`), or a mosaic Cloud Optimized GeoTIFF per zoom level (`cog`, requires rasterio) (default: %(default)s)')
+parser.add_argument('--capabilities-ttl', type=float, metavar='Seconds', default=capabilities_ttl, help='Time the capabilities are reused from the cache in the output folder before checking the server for changes. 0 always checks them (default: %(default)s)')
+parser.add_argument('--shard', type=str, metavar='Shard', default=shard, help='Only download one part of the tiles, `i/N` being the part `i` of `N` (from 1 to N), to split a job between several processes or machines (default: %(default)s)')
+parser.add_argument('--lease', action='store_true', help='Share the job with other processes using the same output folder: each one leases blocks of tiles in the manifest and downloads them, and the blocks of a process that stops are taken by the others (default: %(default)s)')
+parser.add_argument('--lease-size', type=int, metavar='Tiles', default=lease_size, help='Side, in tiles, of the blocks leased with `--lease` (default: %(default)s)')
+parser.add_argument('--lease-ttl', type=float, metavar='Seconds', default=lease_ttl, help='Time a lease lasts if the process that holds it stops renewing it (default: %(default)s)')
+parser.add_argument('--metrics-log', type=str, metavar='JSON lines file', default=None, help='Append the counters, rates and timings of each stage (plan, throttle, request, receive, write, commit) to a file every `metrics-interval` seconds (default: %(default)s)')
+parser.add_argument('--metrics-interval', type=float, metavar='Seconds', default=metrics_interval, help='Seconds between the lines of the metrics log (default: %(default)s)')
+parser.add_argument('--metrics-port', type=int, metavar='Port', default=None, help='Serve the metrics in the Prometheus text format at `http://<metrics-host>:<port>/metrics` while running (default: %(default)s)')
+parser.add_argument('--metrics-host', type=str, metavar='Host', default='127.0.0.1', help='Interface the metrics are served on, `0.0.0.0` for all of them (default: %(default)s)')
+parser.add_argument('--profile', type=str, metavar='Stats file', default=None, help='Profile the run with cProfile and save the stats to a file. Only the main thread is profiled, use py-spy for the workers (default: %(default)s)')
+parser.add_argument('--timeout', type=float, metavar='Timeout', default=timeout, help='Timeout (in seconds) for each tile request (default: %(default)s)')
+
+
+def init(args):
 
     try:
 
@@ -47,265 +75,89 @@ def init():
 
         print('\t')
 
-        # check if output folder exists
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-
-        if not os.path.exists(tmp_folder):
-            os.makedirs(tmp_folder)
-
-        url = args.url
-        format = args.format
-        zoom = int(args.zoom)
-        proj = args.proj
-        layer_id = args.layer 
-        output_folder = args.output
-        limit_requests = args.limit
-        remove_old = args.removeold
-        sleep = args.sleep
-        bbox = args.bbox
-
-        download_count = 1
-        skip_count = 0 
-
-        print(f'Connecting to server: {url}')
-
-        try:
-            wmts = WebMapTileService(url)
-        except Exception as error:
-            print(f"{Fore.RED}-> Can't connect to server{Style.RESET_ALL}")
-            print(f'{Fore.RED}--> PROCESS WAS ABORTED WITH ERRORS <--{Style.RESET_ALL}')
-            return
-
-        print(f'{Fore.GREEN}-> Connection successful{Style.RESET_ALL}')
-        print(f'-> Title: {wmts.identification.title}')
-        print(f'-> Access constraints: {wmts.identification.accessconstraints}')
-
-        contents = wmts.contents
-
-        print('\t')
-
-        for layer in wmts.contents:
-            layer = contents[layer]
-
-            if layer.id == layer_id:
-
-                print(f'-> Layer {layer_id} found')
-
-                title = layer.title
-                abstract = layer.abstract
-                extent = layer.boundingBoxWGS84
-                formats = layer.formats
-
-                print(f'--> Title: {title}')
-                print(f'--> Abstract: {abstract}')
-                print(f'--> Bounding Box WGS84: {extent}')
-                print(f'--> Available formats: {formats}')
-
-                tile_matrixs_links = layer.tilematrixsetlinks
-
-                print(f'--> Available tile matrix sets: {layer._tilematrixsets}')
-
-                for tile_matrix_set in tile_matrixs_links:
-
-                    if tile_matrix_set == proj:
-
-                        tile_matrix_link = tile_matrixs_links[tile_matrix_set]
-
-                        tile_matrix = wmts.tilematrixsets[tile_matrix_set].tilematrix
-
-                        for tml in tile_matrix:
-
-                            z = int(tml.split(":")[-1])
-
-                            if z == zoom:
-                                limit = tml
-
-                        matrix_limits = tile_matrix_link.tilematrixlimits[limit]
+        layer_id = args.layer
+        zooms = [args.zoom]
 
-                        # important
-                        matrix = tile_matrix[limit]
+        if args.zoom_range:
+            (min_zoom, max_zoom) = sorted(int(z) for z in args.zoom_range.split('-'))
+            zooms = list(range(min_zoom, max_zoom + 1))
 
-                        min_row = matrix_limits.mintilerow
-                        max_row = matrix_limits.maxtilerow
+        shard = None
+        if args.shard:
+            (shard_index, shard_count) = (int(value) for value in args.shard.split('/'))
+            if not 1 <= shard_index <= shard_count:
+                raise Exception('`--shard` must be `i/N`, with `i` between 1 and N')
+            shard = (shard_index - 1, shard_count)
 
-                        min_col = matrix_limits.mintilecol
-                        max_col = matrix_limits.maxtilecol
+        summary = download_layer(args.url, layer_id, zooms, output_folder=args.output, format=args.format, proj=args.proj, bbox=args.bbox, aoi=args.aoi,
+                                 order=args.order, workers=args.workers, pool_size=args.pool, timeout=args.timeout, store_type=args.store,
+                                 limit_requests=args.limit, remove_old=args.removeold, refresh=args.refresh, skip_empty=args.skip_empty,
+                                 rate=args.rate, max_rate=args.max_rate, sleep=args.sleep, max_retries=args.retries,
+                                 capabilities_ttl=args.capabilities_ttl, shard=shard, lease=args.lease, lease_size=args.lease_size, lease_ttl=args.lease_ttl)
 
-                        print(min_col, max_col, min_row, max_row)
-
-                        # check if output folder exists
-                        output_folder = f'{output_folder}\\{layer_id}\\{proj.replace(":", "-")}\\{zoom}'
-
-                        if remove_old:
-                            if os.path.exists(output_folder):
-                                print('Removing old files...')
-                                shutil.rmtree(output_folder)
-                        
-                        # create folder if not exists
-                        if not os.path.exists(output_folder):
-                            os.makedirs(output_folder)
-
-                        print('\t')
-                        print('Downloading images...')
-                        
-                        if bbox:
-                            (f_min_col, f_max_col, f_min_row, f_max_row) = filter_row_cols_by_bbox(matrix, bbox)
-                            
-                            print(f_min_col, f_max_col, f_min_row, f_max_row)
-
-                            # clamp values
-                            min_col = f_min_col if f_min_col >= min_col else min_col
-                            max_col = f_max_col if f_max_col <= max_col else max_col
-                            min_row = f_min_row if f_min_row >= min_row else min_row
-                            max_row = f_max_row if f_max_row <= max_row else max_row
-                        
-                        print(min_col, max_col, min_row, max_row)
-
-                        for row in range(min_row, max_row):
-
-                            for col in range(min_col, max_col):
-                                                      
-                                extension = format.split("/")[-1]
-                                file_name = f'{layer_id}__{proj.replace(":", "-")}_row-{row}_col-{col}_zoom-{zoom}'
-
-                                # skip already downloaded files
-                                if tile_already_exists(file_name, extension):
-                                    print(f'--> Skipped existing tile: Column {col} - Row {row} - Zoom {zoom}')
-                                    skip_count += 1
-                                    continue
-
-                                print(f'--> Downloading tile ({download_count}): Column {col} - Row {row} - Zoom {zoom}')
-
-                                img = wmts.gettile(
-                                    url,
-                                    layer=layer_id,
-                                    tilematrixset=tile_matrix_set,
-                                    tilematrix=limit,
-                                    row=row,
-                                    column=col,
-                                    format=format
-                                )
-
-                                write_world_file(file_name, extension, col, row, matrix)
-                                
-                                write_image(file_name, extension, img)
-                                
-                                if limit_requests:
-                                    if download_count >= limit_requests:
-                                        break
-
-                                download_count += 1
-                                
-                                if sleep:
-                                    time.sleep(sleep)
-
-                            else:
-                                continue # only executed if the inner loop did NOT break
-                            break  # only executed if the inner loop DID break
-
-        if os.path.exists(tmp_folder):
-            print(f'-> Removing tmp files...')
-            shutil.rmtree(tmp_folder)
+        if summary is None:
+            print(f'{Fore.RED}--> PROCESS WAS ABORTED WITH ERRORS <--{Style.RESET_ALL}')
+            return
 
         print('\t')
         print('--> PROCESS WAS COMPLETED <--')
         print('------------------------------')
         print(f'-> Layer: {layer_id}')
-        print(f'-> Format: {format}')
-        print(f'-> Projection: {proj}')
-        print(f'-> Zoom: {zoom}')
+        print(f'-> Format: {args.format}')
+        print(f'-> Projection: {args.proj}')
+        print(f'-> Zoom: {zooms[0]}-{zooms[-1]}' if len(zooms) > 1 else f'-> Zoom: {zooms[0]}')
         print('------------------------------')
 
-        if skip_count:
-            print(f'-> Skipped images: {skip_count}')
+        if summary['skipped']:
+            print(f'-> Skipped images: {summary["skipped"]}')
+
+        if summary['empty']:
+            print(f'-> Skipped tiles with an empty parent: {summary["empty"]}')
 
-        if download_count:
-            print(f'{Fore.GREEN}-> Downloaded files: {download_count}{Style.RESET_ALL}')
+        if summary['downloaded']:
+            print(f'{Fore.GREEN}-> Downloaded files: {summary["downloaded"]}{Style.RESET_ALL}')
         else:
             print(f'{Fore.YELLOW}-> No files downloaded{Style.RESET_ALL}')
-        
+
+        if summary['unchanged']:
+            print(f'-> Unchanged tiles: {summary["unchanged"]}')
+
+        if summary['referenced']:
+            print(f'-> Duplicated tiles: {summary["duplicates"]}/{summary["saved"]} ({summary["referenced"] / summary["saved"]:.1%} saved by reference)')
+        elif summary['duplicates']:
+            print(f'-> Duplicated tiles: {summary["duplicates"]}/{summary["saved"]}')
+
+        if summary['failed']:
+            print(f'{Fore.RED}-> Failed tiles: {len(summary["failed"])} (rerun the script to try them again){Style.RESET_ALL}')
+
         print('------------------------------')
-        
-        total_tiles = (max_row - min_row) * (max_col - min_col)
 
-        print(f'-> Total tiles in layer: {total_tiles}')
-        print(f'-> Tiles remaining: {total_tiles - (skip_count + download_count)}')
+        print(f'-> Total tiles in layer: {summary["total"]}')
+        print(f'-> Tiles remaining: {summary["total"] - summary["done"]}')
 
         print('------------------------------')
 
+        # summed over the workers, the largest one is what the run waited on
+        stages = metrics.snapshot()['stages']
+        if stages:
+            print('-> Time by stage: ' + ', '.join(f'{stage} {stage_metrics["seconds"]:.1f}s' for (stage, stage_metrics) in stages.items()))
+            print('------------------------------')
+
     except Exception as error:
         print(f'{Fore.RED}{error}{Style.RESET_ALL}')
         print(traceback.format_exc())
 
 
-def filter_row_cols_by_bbox(matrix, bbox):
-    
-    a = matrix.scaledenominator * 0.00028
-    e = matrix.scaledenominator * -0.00028
-
-    column_orig = math.floor((float(bbox[0]) - matrix.topleftcorner[0]) / (a * matrix.tilewidth))
-    row_orig = math.floor((float(bbox[1]) - matrix.topleftcorner[1]) / (e * matrix.tilewidth))
-
-    column_dest = math.floor((float(bbox[2]) - matrix.topleftcorner[0]) / (a * matrix.tilewidth))
-    row_dest = math.floor((float(bbox[3]) - matrix.topleftcorner[1]) / (e * matrix.tilewidth))
-
-    if (column_orig > column_dest):
-        t = column_orig
-        column_orig = column_dest
-        column_dest = t
-
-    if (row_orig > row_dest):
-        t = row_orig
-        row_orig = row_dest
-        row_dest = t
-
-    column_dest += 1
-    row_dest += 1
-
-    return (column_orig, column_dest, row_orig, row_dest)
-
-def tile_already_exists(file_name, extension):
-    file_path = f'{output_folder}\\{file_name}.{extension}'
-    return os.path.exists(file_path)
-    
-
-def write_image(file_name, extension, img):
-    '''
-    Writes images
-    '''
-    file_path = f'{output_folder}\\{file_name}.{extension}'
-
-    out = open(file_path, 'wb')
-    out.write(img.read())
-    out.close()
-
-
-def write_world_file(file_name, extension, col, row, matrix):
-    '''
-    Writes world file
-    https://gdal.org/drivers/raster/wld.html
-    https://en.wikipedia.org/wiki/World_file
-    '''
-
-    if extension == 'png':
-        wf_ext = 'pgw'
-    elif extension == 'tiff' or extension == 'tiff':
-        wf_ext = 'tfw'
-    elif extension == 'jpg' or extension == 'jpeg':
-        wf_ext = 'jgw'
-    elif extension == 'gif':
-        wf_ext = 'gfw'
-    else:
-        wf_ext = 'wld'
-
-    pixel_size = 0.00028 # Each pixel is assumed to be 0.28mm
-    a = matrix.scaledenominator * pixel_size
-    e = matrix.scaledenominator * -pixel_size
-    left = ((col * matrix.tilewidth + 0.5) * a) + matrix.topleftcorner[0]
-    top = ((row * matrix.tileheight + 0.5) * e) + matrix.topleftcorner[1]
-
-    with open(f'{output_folder}\\{file_name}.{wf_ext}', 'w') as f:
-        f.write('%f\n%d\n%d\n%f\n%f\n%f' % (a, 0, 0, e, left, top))
-
-init()
\ No newline at end of file
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.metrics_log:
+        metrics.start_log(args.metrics_log, args.metrics_interval)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+
+    try:
+        run_profiled(lambda: init(args), args.profile)
+    finally:
+        metrics.close()
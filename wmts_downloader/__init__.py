@@ -0,0 +1,14 @@
+'''
+Download WMTS layers as streams of tiles. `plan_tiles` yields the tiles of a zoom level of a
+`TileLayer`, `fetch_tiles` requests them with bounded concurrency and yields the responses, and
+`download_layer` runs a whole resumable job into one of the stores. Combining the tiles into
+cards (`wmts_downloader.combine`, with `mosaic`) requires rasterio and geopandas
+'''
+
+from .metrics import Metrics, run_profiled
+from .capabilities import TileLayer, create_session
+from .planning import plan_tiles, load_aoi
+from .fetching import RateLimiter, TileError, fetch_tiles, download_tiles, get_tile, metrics
+from .manifest import Manifest
+from .stores import FileStore, MBTilesStore, GeoPackageStore, CogStore
+from .download import download_layer
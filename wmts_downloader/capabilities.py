@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import hashlib
+import requests
+from urllib.parse import urlencode, quote
+from requests.adapters import HTTPAdapter
+from colorama import Fore, Style
+from types import SimpleNamespace
+from owslib.wmts import WebMapTileService, WMTSCapabilitiesReader
+
+from .planning import filter_row_cols_by_bbox
+
+
+class TileLayer:
+    '''
+    A layer of a WMTS service in one of its tile matrix sets, read once from the (cached)
+    capabilities. Gives the tile matrix, the range of tiles and the url of each zoom level
+    '''
+
+    def __init__(self, url, layer_id, proj='EPSG:3857', format='image/png', cache_folder='output/capabilities', capabilities_ttl=86400, timeout=30):
+        self.url = url
+        self.proj = proj
+        self.format = format
+
+        self.wmts = get_capabilities(url, layer_id, proj, cache_folder, capabilities_ttl, timeout)
+
+        self.layer = self.wmts.contents.get(layer_id)
+
+        if not self.layer:
+            raise LookupError(f'Layer {layer_id} not found')
+
+        if proj not in self.layer.tilematrixsetlinks:
+            raise LookupError(f'Tile matrix set {proj} not found in the layer {layer_id}')
+
+        self.tile_matrix = self.wmts.tilematrixsets[proj].tilematrix
+        self.tile_matrix_link = self.layer.tilematrixsetlinks[proj]
+
+        # tile matrix identifier of each zoom level
+        self.limits = {int(identifier.split(':')[-1]): identifier for identifier in self.tile_matrix}
+
+    def get_matrix(self, zoom):
+        return self.tile_matrix[self.limits[zoom]]
+
+    def get_tiles_range(self, zoom, bbox=None):
+        '''
+        (min_row, max_row, min_col, max_col) of the zoom level, the maximums excluded,
+        clamped to the bbox if there is one
+        '''
+
+        matrix_limits = self.tile_matrix_link.tilematrixlimits[self.limits[zoom]]
+
+        # the limits are inclusive, the ranges are not
+        min_row = matrix_limits.mintilerow
+        max_row = matrix_limits.maxtilerow + 1
+
+        min_col = matrix_limits.mintilecol
+        max_col = matrix_limits.maxtilecol + 1
+
+        if bbox:
+            (f_min_col, f_max_col, f_min_row, f_max_row) = filter_row_cols_by_bbox(self.get_matrix(zoom), bbox)
+
+            # clamp values
+            min_col = max(f_min_col, min_col)
+            max_col = min(f_max_col, max_col)
+            min_row = max(f_min_row, min_row)
+            max_row = min(f_max_row, max_row)
+
+        return (min_row, max_row, min_col, max_col)
+
+    def get_tile_url(self, zoom):
+        return get_tile_url_template(self.url, self.layer, self.proj, self.limits[zoom], self.format)
+
+
+def get_capabilities(url, layer_id, proj, cache_folder, ttl, timeout):
+    '''
+    Capabilities of the server, cached on disk by url. Within the `ttl` the cache is used without
+    any request, then it is revalidated with a conditional request (ETag / Last-Modified).
+    The layer and tile matrix set used are also saved as a small record, so while the document
+    doesn't change it is not parsed again. A cached document that doesn't match its metadata is
+    requested again
+    '''
+
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+
+    key = hashlib.sha1(url.encode()).hexdigest()
+    xml_path = f'{cache_folder}/{key}.xml'
+    meta_path = f'{cache_folder}/{key}.json'
+    record_path = f'{cache_folder}/{key}-{hashlib.sha1(f"{layer_id}|{proj}".encode()).hexdigest()}.json'
+
+    meta = read_json_file(meta_path) if os.path.exists(xml_path) else None
+    content = None
+
+    if not meta or time.time() - meta['fetched'] >= ttl:
+        (meta, content) = update_capabilities(url, xml_path, meta_path, meta, timeout)
+
+    record = read_json_file(record_path) if os.path.exists(record_path) else None
+
+    if record and record['checksum'] == meta['checksum']:
+        print('-> Capabilities read from the cache')
+        return get_capabilities_from_record(record)
+
+    if content is None:
+        content = read_file(xml_path)
+
+        # replaced by another process, or left by a run interrupted before the metadata was written
+        if content is None or hashlib.sha256(content).hexdigest() != meta['checksum']:
+            (meta, content) = update_capabilities(url, xml_path, meta_path, None, timeout)
+
+    wmts = WebMapTileService(url, xml=content)
+
+    record = get_capabilities_record(wmts, layer_id, proj)
+
+    if record:
+        record['checksum'] = meta['checksum']
+        write_file(record_path, json.dumps(record).encode())
+
+    return wmts
+
+
+def update_capabilities(url, xml_path, meta_path, meta, timeout):
+    '''
+    Requests the capabilities, conditionally if there is a cached copy, and saves them with their
+    metadata. Returns the metadata and the content, None if the cached copy is still valid
+    '''
+
+    headers = {}
+
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(WMTSCapabilitiesReader().capabilities_url(url), headers=headers, timeout=timeout)
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        if not meta:
+            raise
+        print(f'{Fore.YELLOW}-> The server is not available, using the cached capabilities{Style.RESET_ALL}')
+        return (meta, None)
+
+    content = None
+
+    if response.status_code != 304:
+        content = response.content
+        write_file(xml_path, content)
+        meta = {'checksum': hashlib.sha256(content).hexdigest()}
+
+    meta.update({
+        'etag': response.headers.get('ETag', meta.get('etag')),
+        'last_modified': response.headers.get('Last-Modified', meta.get('last_modified')),
+        'fetched': time.time()
+    })
+    write_file(meta_path, json.dumps(meta).encode())
+
+    return (meta, content)
+
+
+def get_capabilities_record(wmts, layer_id, proj):
+    '''
+    The parts of the capabilities used to download a layer, as plain values
+    '''
+
+    layer = wmts.contents.get(layer_id)
+
+    if not layer or proj not in layer.tilematrixsetlinks or proj not in wmts.tilematrixsets:
+        return None
+
+    return {
+        'title': wmts.identification.title,
+        'accessconstraints': wmts.identification.accessconstraints,
+        'layer': {
+            'id': layer.id,
+            'title': layer.title,
+            'abstract': layer.abstract,
+            'boundingBoxWGS84': layer.boundingBoxWGS84,
+            'formats': layer.formats,
+            'styles': layer.styles,
+            'resourceURLs': layer.resourceURLs,
+            '_tilematrixsets': layer._tilematrixsets
+        },
+        'tilematrixset': proj,
+        'tilematrix': {identifier: vars(matrix) for (identifier, matrix) in wmts.tilematrixsets[proj].tilematrix.items()},
+        'tilematrixlimits': {identifier: vars(limits) for (identifier, limits) in layer.tilematrixsetlinks[proj].tilematrixlimits.items()}
+    }
+
+
+def get_capabilities_from_record(record):
+    '''
+    Rebuilds, from a record, the same attributes of the OWSLib capabilities that are used here
+    '''
+
+    tilematrix = {}
+
+    for (identifier, matrix) in record['tilematrix'].items():
+        matrix = SimpleNamespace(**matrix)
+        matrix.topleftcorner = tuple(matrix.topleftcorner)
+        tilematrix[identifier] = matrix
+
+    layer = SimpleNamespace(**record['layer'])
+    layer.boundingBoxWGS84 = tuple(layer.boundingBoxWGS84) if layer.boundingBoxWGS84 else None
+    layer.tilematrixsetlinks = {
+        record['tilematrixset']: SimpleNamespace(tilematrixlimits={
+            identifier: SimpleNamespace(**limits) for (identifier, limits) in record['tilematrixlimits'].items()
+        })
+    }
+
+    return SimpleNamespace(
+        identification=SimpleNamespace(title=record['title'], accessconstraints=record['accessconstraints']),
+        contents={layer.id: layer},
+        tilematrixsets={record['tilematrixset']: SimpleNamespace(tilematrix=tilematrix)}
+    )
+
+
+def read_json_file(path):
+    try:
+        with open(path, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # missing, or interrupted while being written
+        return None
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def write_file(path, content):
+    '''
+    Writes a file with a temporary name and then renames it, so it is never left half-written
+    '''
+
+    # other processes of the same job may be writing it at the same time
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+
+    with open(tmp_path, 'wb') as file:
+        file.write(content)
+
+    os.replace(tmp_path, path)
+
+
+def create_session(pool_size):
+    '''
+    Creates a http session with a single keep-alive connection pool shared by all the workers
+    '''
+
+    session = requests.Session()
+
+    # `pool_block` makes the workers wait for a free connection instead of opening throwaway ones
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_tile_url_template(url, layer, tile_matrix_set, tile_matrix, format):
+    '''
+    Builds the url template used to request the tiles, with `{TileRow}` and `{TileCol}` placeholders.
+    The RESTful `ResourceURL` is used when the server advertises one for the format, otherwise KVP
+    '''
+
+    # same default as OWSLib
+    style = next((key for key, value in layer.styles.items() if value.get('isDefault')), None)
+    if style is None:
+        style = list(layer.styles.keys())[0] if layer.styles else ''
+
+    for resource in layer.resourceURLs:
+        if resource['resourceType'] == 'tile' and resource['format'] == format:
+            template = resource['template']
+            template = template.replace('{Style}', quote(style, safe=':'))
+            template = template.replace('{style}', quote(style, safe=':'))
+            template = template.replace('{TileMatrixSet}', quote(tile_matrix_set, safe=':'))
+            template = template.replace('{TileMatrix}', quote(tile_matrix, safe=':'))
+            return template
+
+    params = urlencode([
+        ('SERVICE', 'WMTS'),
+        ('REQUEST', 'GetTile'),
+        ('VERSION', '1.0.0'),
+        ('LAYER', layer.id),
+        ('STYLE', style),
+        ('TILEMATRIXSET', tile_matrix_set),
+        ('TILEMATRIX', tile_matrix),
+        ('FORMAT', format)
+    ])
+
+    if '?' not in url:
+        url = f'{url}?'
+    elif not url.endswith('?') and not url.endswith('&'):
+        url = f'{url}&'
+
+    return f'{url}{params}&TILEROW={{TileRow}}&TILECOL={{TileCol}}'
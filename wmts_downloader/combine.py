@@ -0,0 +1,980 @@
+import os
+import json
+import time
+import sqlite3
+import itertools
+import collections
+import rasterio
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy
+from rasterio.windows import Window
+from rasterio.features import geometry_window
+from rasterio.warp import calculate_default_transform, reproject, Resampling
+from xml.sax.saxutils import escape
+
+from shapely.geometry import box, mapping, shape
+
+import geopandas as gpd
+from colorama import Fore, Style
+
+from .metrics import Metrics
+from .planning import get_hilbert_index
+
+# RGBA bands mapping of the tiles already opened, shared by the cards of a process
+tiles_bands = {}
+
+# decoded tiles, shared by the cards of a process, see `get_tile_cache`
+tile_cache = None
+
+# timers of each stage, the cards converted by other processes are merged when they finish
+metrics = Metrics('combine_ign')
+
+
+def combine_cards(input_folder='output/cartas_50k/EPSG-3857/15', output_folder='output/merged', cards_file='cartas.geojson', progress_path='progress.sqlite',
+                  jobs=1, warp_threads=None, warp_mem=256, strip_rows=512, chunk_size=10000, output_profile=None, cache_size=512):
+    '''
+    Matches the tiles of a zoom folder with the cards of a GeoJSON file, and converts each card
+    with `mosaic`. The progress is saved in a `Checkpoint` at `progress_path`: the tiles are matched
+    by chunks of `chunk_size`, only the ones not matched by a previous run, and the cards already
+    converted are skipped. The cards are written with the `output_profile` (see `get_output_profile`),
+    following the Hilbert curve, so consecutive cards share the `cache_size` MB of decoded tiles of each process.
+    Returns the number of tiles matched
+    '''
+
+    jobs = max(1, jobs)
+
+    # the processes share the CPUs
+    warp_threads = warp_threads or max(1, (os.cpu_count() or 1) // jobs)
+
+    checkpoint = Checkpoint(progress_path)
+
+    try:
+        # progress saved by older versions
+        legacy_path = os.path.join(os.path.dirname(progress_path), 'progress_tmp.json')
+        if not checkpoint.get_state('count') and os.path.exists(legacy_path):
+            imported = import_json_progress(checkpoint, legacy_path)
+            print(f'-> Imported {imported} cards from {legacy_path}')
+
+        # blank tiles add nothing to the cards
+        blank_tiles = get_blank_tiles(input_folder)
+        blank_count = 0
+
+        tiles_count = 0
+        new_count = 0
+        gdf_cards = None
+
+        for chunk in iter_chunks(iter_images(input_folder), chunk_size):
+            tiles = [tile for tile in chunk if get_tile_position(tile) not in blank_tiles]
+            blank_count += len(chunk) - len(tiles)
+            tiles_count += len(tiles)
+
+            # the tiles and cards attributes are read once, from the first tile, and kept for the next runs
+            if tiles and not checkpoint.get_state('grid'):
+                file_name = os.path.basename(tiles[0])
+                attributes = parse_tile_name(file_name)
+
+                # tiles names are like `cartas_50k__EPSG-3857_row-1234_col-5678_zoom-15.png`
+                checkpoint.set_state(
+                    master_layer_name=file_name.split('__')[0].split('.')[0],
+                    crs=attributes['crs'],
+                    zoom=f'zoom-{attributes["zoom"]}',
+                    grid=get_tile_grid(tiles[0]))
+
+            tiles = checkpoint.get_new_tiles(tiles)
+
+            if not tiles:
+                continue
+
+            if gdf_cards is None:
+                print('-> Matching tiles')
+                gdf_cards = gpd.read_file(cards_file)
+
+            with metrics.timer('match'):
+                (matches, cards) = match_tiles(tiles, checkpoint.get_state('grid'), gdf_cards)
+
+            # the tiles of the chunk are recorded with their cards at once
+            checkpoint.add_matches(tiles, matches, cards)
+            new_count += len(tiles)
+
+        if blank_count:
+            print(f'-> Blank tiles skipped: {blank_count}')
+
+        if not checkpoint.get_state('grid'):
+            raise Exception(f'No tiles found in {input_folder}')
+
+        print(f'Total tiles: {tiles_count}')
+
+        if new_count:
+            print(f'-> New tiles matched: {new_count}')
+
+        matched_count = checkpoint.get_state('matched')
+
+        print(
+            f'{Fore.GREEN}-> Tiles matched: {matched_count}/{checkpoint.get_state("count")}{Style.RESET_ALL}')
+
+        print('-> Starting conversion')
+
+        (cards_count, pending) = (checkpoint.count_cards(), order_cards(checkpoint.get_pending_cards()))
+
+        print(f'-> {cards_count} images to convert')
+
+        if len(pending) < cards_count:
+            print(f'-> {cards_count - len(pending)} images already converted')
+
+        if jobs > 1:
+            print(f'-> Converting with {jobs} processes')
+
+        # the tiles of each card are only read when it is about to be converted
+        cards = (checkpoint.get_card(id_carta) for id_carta in pending)
+
+        (master_layer_name, crs, zoom, grid) = (checkpoint.get_state(name) for name in ('master_layer_name', 'crs', 'zoom', 'grid'))
+        layer_name = master_layer_name
+
+        def report(event, index, id_carta, **details):
+            if event == 'start':
+                print(f'-> Conversion Nº {index+1} - {id_carta}')
+            elif event == 'warning':
+                print(f'{Fore.RED}Error: {details["message"]}{Style.RESET_ALL}')
+
+        for (index, id_carta, card_metrics) in mosaic(cards, grid, output_folder, master_layer_name, layer_name, zoom, crs, jobs, warp_threads, warp_mem, strip_rows, output_profile, cache_size, report):
+
+            if card_metrics:
+                metrics.merge(card_metrics)
+                print(f'-> Conversion Nº {index+1} - {id_carta} finished in {card_metrics["stages"]["convert"][1]:.1f}s')
+            else:
+                print(f'-> Conversion Nº {index+1} - {id_carta} finished')
+
+            # only the main process writes the progress
+            checkpoint.set_converted(id_carta)
+
+        counters = metrics.snapshot()['counters']
+        if counters.get('cache_hits') or counters.get('cache_misses'):
+            print(f'-> Tile cache: {counters.get("cache_hits", 0)} hits, {counters.get("cache_misses", 0)} decoded, '
+                  f'{counters.get("cache_evictions", 0)} evicted, {counters.get("cache_bypassed", 0)} read without caching')
+
+    finally:
+        checkpoint.close()
+
+    return matched_count
+
+
+class Checkpoint:
+    '''
+    Progress of the combination, stored in a SQLite database (WAL mode). Each chunk of tiles is
+    recorded together with the cards it intersects in a single transaction, so an interrupted run
+    only matches again the tiles it hadn't reached. The cards are marked as converted one by one,
+    and only the pending ones are read back, each with its tiles, right before converting it
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        # values of the whole run, as json
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID')
+
+        # tiles already matched, with or without cards
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tiles (path TEXT PRIMARY KEY) WITHOUT ROWID')
+
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS cards (
+                id_carta TEXT PRIMARY KEY,
+                faja TEXT,
+                geom TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS card_tiles (id_carta TEXT NOT NULL, tile TEXT NOT NULL, PRIMARY KEY (id_carta, tile)) WITHOUT ROWID')
+
+        # to find the tiles shared by several cards
+        self.connection.execute('CREATE INDEX IF NOT EXISTS card_tiles_tile ON card_tiles (tile)')
+        self.connection.commit()
+
+    def get_state(self, name, default=None):
+        row = self.connection.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, **values):
+        with self.connection:
+            self._set_state(values)
+
+    def _set_state(self, values):
+        self.connection.executemany('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)',
+                                    ((name, json.dumps(value)) for (name, value) in values.items()))
+
+    def get_new_tiles(self, tiles, batch_size=500):
+        '''
+        The tiles that were not matched yet, checked by batches against the primary key
+        '''
+
+        known = set()
+
+        for start in range(0, len(tiles), batch_size):
+            batch = tiles[start:start + batch_size]
+            cursor = self.connection.execute(f'SELECT path FROM tiles WHERE path IN ({", ".join("?" * len(batch))})', batch)
+            known.update(path for (path,) in cursor)
+
+        return [tile for tile in tiles if tile not in known]
+
+    def add_matches(self, tiles, matches, cards):
+        '''
+        Records a chunk of tiles, its (id_carta, tile) matches and the cards found, and updates the counts
+        '''
+
+        now = time.time()
+
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO tiles (path) VALUES (?)', ((tile,) for tile in tiles))
+
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO cards (id_carta, faja, geom, status, updated) VALUES (?, ?, ?, 'pending', ?)",
+                ((id_carta, card['faja'], json.dumps(card['geom']), now) for (id_carta, card) in cards.items()))
+
+            self.connection.executemany('INSERT OR IGNORE INTO card_tiles (id_carta, tile) VALUES (?, ?)', matches)
+
+            self._set_state({
+                'count': self.get_state('count', 0) + len(tiles),
+                'matched': self.get_state('matched', 0) + len({tile for (_, tile) in matches})
+            })
+
+    def count_cards(self):
+        return self.connection.execute('SELECT COUNT(*) FROM cards').fetchone()[0]
+
+    def get_pending_cards(self):
+        '''
+        (id_carta, geometry) of the cards still to convert
+        '''
+
+        return [(id_carta, json.loads(geom)) for (id_carta, geom) in self.connection.execute("SELECT id_carta, geom FROM cards WHERE status = 'pending' ORDER BY rowid")]
+
+    def get_card(self, id_carta):
+        (faja, geom) = self.connection.execute('SELECT faja, geom FROM cards WHERE id_carta = ?', (id_carta,)).fetchone()
+        tiles = self.connection.execute(
+            'SELECT tile, (SELECT COUNT(*) FROM card_tiles AS other WHERE other.tile = card_tiles.tile) FROM card_tiles WHERE id_carta = ?',
+            (id_carta,)).fetchall()
+
+        return {
+            'path': tiles[0][0],
+            'faja': faja,
+            'id_carta': id_carta,
+            'geom': json.loads(geom),
+            'tiles': [tile for (tile, _) in tiles],
+            'shared': [tile for (tile, cards) in tiles if cards > 1]
+        }
+
+    def set_converted(self, id_carta):
+        with self.connection:
+            self.connection.execute("UPDATE cards SET status = 'converted', updated = ? WHERE id_carta = ?", (time.time(), id_carta))
+
+    def close(self):
+        self.connection.close()
+
+
+def import_json_progress(checkpoint, path):
+    '''
+    Imports the cards matched and converted by older versions, which kept them in a json file.
+    Their tiles are recorded as matched, the rest of the tiles are matched again
+    '''
+
+    with open(path, 'r') as file:
+        progress = json.load(file)
+
+    cards = {image['id_carta']: {'faja': image['faja'], 'geom': image['geom']} for image in progress['images']}
+    matches = [(image['id_carta'], tile) for image in progress['images'] for tile in image['tiles']]
+
+    # the tiles on the edge of a card are listed in each card they intersect
+    checkpoint.add_matches(list(dict.fromkeys(tile for (_, tile) in matches)), matches, cards)
+
+    for id_carta in progress.get('converted', []):
+        checkpoint.set_converted(id_carta)
+
+    return len(progress['images'])
+
+
+def mosaic(cards, grid, output_folder, master_layer_name, layer_name, zoom, crs, jobs=1, warp_threads=None, warp_mem=256, strip_rows=512, output_profile=None, cache_size=512, report=None):
+    '''
+    Converts the cards, as collected by `match_tiles`, and yields `(index, id_carta, metrics)` as each
+    one finishes. With several `jobs` the cards are converted in that many processes, and only a few
+    more cards than processes are submitted at a time, so a long list of cards is not all queued at once
+    and nothing else is converted while the yielded results are not consumed.
+    `report(event, index, id_carta, **details)` is called from this process when a card starts to be converted
+    without `jobs` (`start`), and with the problems found converting it (`warning`, with a `message`)
+    '''
+
+    report = report or (lambda event, index, id_carta, **details: None)
+
+    def get_result(index, id_carta, card_metrics, messages):
+        for message in messages:
+            report('warning', index, id_carta, message=message)
+        return (index, id_carta, card_metrics)
+
+    if jobs <= 1:
+        for (index, tiles_collected) in enumerate(cards):
+            report('start', index, tiles_collected['id_carta'])
+            yield get_result(index, *convert_card(tiles_collected, grid, output_folder, master_layer_name, layer_name, zoom, crs, warp_threads, warp_mem, strip_rows, output_profile, cache_size))
+        return
+
+    executor = ProcessPoolExecutor(max_workers=jobs)
+
+    cards = enumerate(cards)
+    pending = {}
+
+    try:
+        while True:
+            for (index, tiles_collected) in cards:
+                future = executor.submit(convert_card, tiles_collected, grid, output_folder, master_layer_name, layer_name, zoom, crs, warp_threads, warp_mem, strip_rows, output_profile, cache_size)
+                pending[future] = index
+
+                if len(pending) >= jobs * 2:
+                    break
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                yield get_result(pending.pop(future), *future.result())
+
+    finally:
+        # don't start the remaining cards, the running ones clean their partial files
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def convert_card(tiles_collected, grid, output_folder, master_layer_name, layer_name, zoom, crs, warp_threads=None, warp_mem=256, strip_rows=512, output_profile=None, cache_size=512):
+    '''
+    Merges, crops and reprojects the tiles of a card. It runs in the worker processes, so it
+    only uses its arguments and a temp folder of its own. The outputs are written with a
+    temporary name and renamed when completed, so an interrupted conversion leaves no half-written files.
+    The format and codec of the outputs come from `output_profile` (see `get_output_profile`), and
+    the tiles are read through the `cache_size` MB cache of decoded tiles of the process.
+    Returns the card id, the timings of its stages and the problems found, to be reported by the caller
+    '''
+
+    faja = tiles_collected['faja']
+    geom = shape(tiles_collected['geom'])
+    tiles = tiles_collected['tiles']
+    id_carta = tiles_collected['id_carta']
+
+    output_profile = output_profile or get_output_profile()
+    threads = warp_threads or 1
+
+    # reported by the caller, this may run in another process
+    messages = []
+
+    output_folder_layer = f'{output_folder}/{master_layer_name}-{zoom}'
+
+    output_folder_layer_crs = f'{output_folder_layer}/{crs.replace(":", "-")}'
+
+    if not os.path.exists(output_folder_layer_crs):
+        os.makedirs(output_folder_layer_crs, exist_ok=True)
+
+    file_final = f'{output_folder_layer_crs}/{layer_name}__{id_carta}_{crs.replace(":", "-")}.tif'
+
+    # skip existing exports
+    if os.path.exists(file_final):
+        return (id_carta, None)
+
+    # sent back to the main process, which may be another one
+    card_metrics = Metrics('combine_ign')
+    started = time.perf_counter()
+
+    # (partial path, final path) of each output, the original projection goes last
+    # because its existence marks the card as converted
+    outputs = []
+
+    # a COG is written to a working copy first, and converted once complete
+    cog = output_profile['format'] == 'cog'
+
+    cache = get_tile_cache(cache_size)
+    cache_stats = dict(cache.stats)
+
+    try:
+        # the tiles on the edges of the card are decoded once for all the cards they are in
+        with card_metrics.timer('decode'):
+            paths = cache.acquire(tiles_collected.get('shared', []))
+
+        # virtual mosaic of the collected tiles, nothing is decoded until it is read
+        # here we remove the alpha channel `4`
+        with card_metrics.timer('mask'):
+            vrt = build_vrt(tiles, grid, crs, indexes=[1, 2, 3], paths=paths)
+
+            with MemoryFile(vrt.encode(), ext='.vrt') as memfile, memfile.open() as mosaic:
+
+                # same window that `mask(crop=True, pad=True)` would use
+                crop_window = geometry_window(mosaic, [geom], pad_x=0.5, pad_y=0.5)
+
+        # the mosaic cropped to the card, source of both projections
+        vrt = build_vrt(tiles, grid, crs, indexes=[1, 2, 3], window=crop_window, paths=paths)
+
+        with MemoryFile(vrt.encode(), ext='.vrt') as memfile, memfile.open() as crop:
+
+            out_meta = crop.meta
+
+            # crop original
+            out_meta.update(get_creation_options(output_profile, threads))
+
+            outputs.append((get_partial_path(file_final), file_final))
+
+            # save original projection
+            with rasterio.open(get_work_path(outputs[-1][0]) if cog else outputs[-1][0], "w", **out_meta) as dst1:
+
+                # copied by strips of rows, so only one strip is in memory at a time
+                with card_metrics.timer('merge'):
+                    for row_off in range(0, dst1.height, strip_rows):
+                        window = Window(0, row_off, dst1.width, min(strip_rows, dst1.height - row_off))
+                        dst1.write(crop.read(window=window), window=window)
+
+                dst1.crs = crs
+
+                # build overviews for geoserver, all the levels at once so each one is computed from the previous
+                if not cog:
+                    with card_metrics.timer('overviews'), rasterio.Env(GDAL_NUM_THREADS=threads, GDAL_TIFF_OVR_BLOCKSIZE=output_profile['blocksize']):
+                        dst1.build_overviews(
+                            [2, 4, 8, 16, 32, 64, 128, 256], Resampling.average)
+
+            if cog:
+                with card_metrics.timer('overviews'):
+                    write_cog(get_work_path(outputs[-1][0]), outputs[-1][0], output_profile, threads)
+
+            dst_crs = calculate_epsg(faja)
+
+            if not dst_crs:
+                messages.append(f'{id_carta} has no projection')
+            else:
+                transform, width, height = calculate_default_transform(
+                    crop.crs, dst_crs, crop.width, crop.height, *crop.bounds)
+                kwargs = crop.meta.copy()
+                kwargs.update({
+                    'crs': dst_crs,
+                    'transform': transform,
+                    'width': width,
+                    'height': height,
+                    **get_creation_options(output_profile, threads)
+                })
+
+                output_folder_layer_crs = f'{output_folder_layer}/{dst_crs.replace(":","-")}'
+
+                if not os.path.exists(output_folder_layer_crs):
+                    os.makedirs(output_folder_layer_crs, exist_ok=True)
+
+                file_reprojected = f'{output_folder_layer_crs}/{layer_name}__{id_carta}_{dst_crs.replace(":","-")}.tif'
+
+                outputs.insert(0, (get_partial_path(file_reprojected), file_reprojected))
+
+                # save reprojected, warped from the tiles instead of the jpeg just written. All bands
+                # go in a single warp, done by chunks of `warp_mem` MB of the destination
+                with rasterio.open(get_work_path(outputs[0][0]) if cog else outputs[0][0], "w", **kwargs) as dst2, card_metrics.timer('reproject'):
+                    bands = list(range(1, crop.count + 1))
+
+                    reproject(
+                        source=rasterio.band(crop, bands),
+                        destination=rasterio.band(dst2, bands),
+                        src_transform=crop.transform,
+                        src_crs=crop.crs,
+                        dst_transform=transform,
+                        dst_crs=dst_crs,
+                        resampling=Resampling.nearest,
+                        num_threads=threads,
+                        warp_mem_limit=warp_mem)
+
+                if cog:
+                    with card_metrics.timer('overviews'):
+                        write_cog(get_work_path(outputs[0][0]), outputs[0][0], output_profile, threads)
+
+        for (partial_path, final_path) in outputs:
+            card_metrics.count('bytes', os.path.getsize(partial_path))
+
+            # the world file first, so a tif is never left without it
+            os.replace(f'{partial_path[:-4]}.tfw', f'{final_path[:-4]}.tfw')
+            os.replace(partial_path, final_path)
+
+        outputs = []
+
+    finally:
+        cache.release()
+
+        for (partial_path, _) in outputs:
+            for path in (partial_path, f'{partial_path[:-4]}.tfw', get_work_path(partial_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    for (name, value) in cache.stats.items():
+        card_metrics.count(f'cache_{name}', value - cache_stats[name])
+
+    card_metrics.count('cards')
+    card_metrics.count('tiles', len(tiles))
+    card_metrics.observe('convert', time.perf_counter() - started)
+
+    return (id_carta, card_metrics.state(), messages)
+
+
+def get_output_profile(format='gtiff', codec='jpeg', quality=80, blocksize=512):
+    '''
+    Format and codec of the cards. `gtiff` is a tiled GeoTIFF with internal overviews, `cog` a Cloud
+    Optimized GeoTIFF, with the overviews after the full resolution so a reader only needs a few
+    range requests. `jpeg` and `webp` are lossy with a `quality` from 1 to 100, `zstd` and `deflate`
+    are lossless. The blocks are `blocksize` pixels wide and high
+    '''
+
+    if format not in ('gtiff', 'cog'):
+        raise Exception(f'Unknown output format {format}, use `gtiff` or `cog`')
+
+    if codec not in ('jpeg', 'webp', 'zstd', 'deflate'):
+        raise Exception(f'Unknown codec {codec}, use `jpeg`, `webp`, `zstd` or `deflate`')
+
+    # tiled GeoTIFFs need blocks multiple of 16
+    if blocksize % 16:
+        raise Exception('The block size must be a multiple of 16')
+
+    return {'format': format, 'codec': codec, 'quality': quality, 'blocksize': blocksize}
+
+
+def get_codec_options(output_profile, driver):
+    '''
+    Compression options of the profile, named as the GTiff or the COG driver expects them
+    '''
+
+    (codec, quality) = (output_profile['codec'], output_profile['quality'])
+
+    if codec == 'jpeg':
+        # YCbCr is implicit in the COG driver
+        return {'compress': 'JPEG', 'quality': quality} if driver == 'COG' else {'compress': 'JPEG', 'jpeg_quality': quality, 'photometric': 'YCBCR'}
+
+    if codec == 'webp':
+        return {'compress': 'WEBP', 'quality': quality} if driver == 'COG' else {'compress': 'WEBP', 'webp_level': quality}
+
+    # the horizontal predictor makes the lossless codecs much better on images
+    return {'compress': codec.upper(), 'predictor': 'YES' if driver == 'COG' else 2}
+
+
+def get_creation_options(output_profile, threads):
+    '''
+    Options of the file an output is written to. A COG is first written into a lossless working copy,
+    fast to write and read back, which `write_cog` converts
+    '''
+
+    blocksize = output_profile['blocksize']
+
+    options = {
+        'driver': 'GTiff',
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'num_threads': threads,
+        'bigtiff': 'IF_SAFER'
+    }
+
+    if output_profile['format'] == 'cog':
+        options.update({'compress': 'DEFLATE', 'zlevel': 1, 'predictor': 2})
+    else:
+        options.update({**get_codec_options(output_profile, 'GTiff'), 'tfw': 'YES'})
+
+    return options
+
+
+def write_cog(work_path, path, output_profile, threads):
+    '''
+    Converts the working copy of an output into a COG with its overviews and world file, and removes it.
+    The overviews and the compression of the blocks are split between `threads` threads
+    '''
+
+    with rasterio.Env(GDAL_NUM_THREADS=threads):
+        copy(work_path, path, driver='COG', blocksize=output_profile['blocksize'], overview_resampling='AVERAGE',
+             num_threads=threads, bigtiff='IF_SAFER', **get_codec_options(output_profile, 'COG'))
+
+    with rasterio.open(path) as dataset:
+        transform = dataset.transform
+
+    # the COG driver doesn't write world files, written as GDAL does with the center of the top left pixel
+    with open(f'{path[:-4]}.tfw', 'w') as file:
+        file.write('\n'.join('%.10f' % value for value in (transform.a, transform.d, transform.b, transform.e, transform.c + transform.a / 2, transform.f + transform.e / 2)) + '\n')
+
+    os.remove(work_path)
+
+
+def order_cards(cards):
+    '''
+    Ids of the cards sorted along a Hilbert curve through their centroids, so the cards converted
+    one after the other are neighbours and share the tiles of their edges
+    '''
+
+    if len(cards) < 3:
+        return [id_carta for (id_carta, _) in cards]
+
+    centroids = np.array([shape(geom).centroid.coords[0] for (_, geom) in cards])
+
+    # the centroids placed in a 1024 x 1024 grid
+    origin = centroids.min(axis=0)
+    extent = max((centroids.max(axis=0) - origin).max(), 1e-9)
+    cells = ((centroids - origin) / extent * 1023).astype('int64')
+
+    order = np.argsort(get_hilbert_index(cells[:, 0], cells[:, 1], 1024), kind='stable')
+
+    return [cards[index][0] for index in order]
+
+
+def get_tile_cache(cache_size):
+    '''
+    The cache of decoded tiles of the process, created by the first card converted in it
+    '''
+
+    global tile_cache
+
+    if tile_cache is None or tile_cache.max_bytes != cache_size * 1024 * 1024:
+        if tile_cache:
+            tile_cache.clear()
+        tile_cache = TileCache(cache_size * 1024 * 1024)
+
+    return tile_cache
+
+
+class TileCache:
+    '''
+    Least recently used tiles, decoded into uncompressed in-memory GeoTIFFs up to `max_bytes`.
+    Within a card GDAL already keeps the decoded blocks, so only the tiles on the edge of several
+    cards are cached, to decode them once instead of once per card, as long as these cards are
+    converted close in time. The tiles of the card being converted are never evicted, and the ones
+    that don't fit are read from their files
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        # tile -> (memory file, bytes), the least recently used first
+        self.entries = collections.OrderedDict()
+        self.pinned = set()
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bypassed': 0}
+
+    def acquire(self, tiles):
+        '''
+        Path to read each tile from, decoding the ones not cached yet while they fit.
+        They stay in the cache at least until `release`
+        '''
+
+        paths = {}
+
+        if not self.max_bytes:
+            return paths
+
+        self.pinned = set(tiles)
+
+        for tile in tiles:
+            if tile in self.entries:
+                self.entries.move_to_end(tile)
+                self.stats['hits'] += 1
+                paths[tile] = self.entries[tile][0].name
+                continue
+
+            with rasterio.open(tile) as src:
+                size = src.width * src.height * src.count * np.dtype(src.dtypes[0]).itemsize
+
+                while self.size + size > self.max_bytes and self.evict():
+                    pass
+
+                if self.size + size > self.max_bytes:
+                    self.stats['bypassed'] += 1
+                    continue
+
+                profile = {
+                    'driver': 'GTiff',
+                    'width': src.width,
+                    'height': src.height,
+                    'count': src.count,
+                    'dtype': src.dtypes[0],
+                    'crs': src.crs,
+                    'transform': src.transform,
+
+                    # a single strip, each read is a copy
+                    'blockysize': src.height
+                }
+
+                memfile = MemoryFile(ext='.tif')
+
+                # only the pixels are needed, the VRT places them
+                with memfile.open(**profile) as dst:
+                    dst.write(src.read())
+
+            self.entries[tile] = (memfile, size)
+            self.size += size
+            self.stats['misses'] += 1
+            paths[tile] = memfile.name
+
+        return paths
+
+    def release(self):
+        self.pinned = set()
+
+    def evict(self):
+        '''
+        Removes the least recently used tile not in use, returns False if there is none
+        '''
+
+        for tile in self.entries:
+            if tile not in self.pinned:
+                (memfile, size) = self.entries.pop(tile)
+                memfile.close()
+                self.size -= size
+                self.stats['evictions'] += 1
+                return True
+
+        return False
+
+    def clear(self):
+        for (memfile, _) in self.entries.values():
+            memfile.close()
+        self.entries.clear()
+        self.size = 0
+
+
+def build_vrt(tiles, grid, crs, indexes, window=None, paths=None):
+    '''
+    VRT xml placing each tile in its position of the mosaic. The position comes from the
+    row and column in the tile name. Tiles with less bands are presented as RGBA by
+    reading the same source band more than once (gray+alpha -> gray, gray, gray, alpha).
+    With a `window` of the mosaic, the VRT only covers that window. `paths` maps
+    tiles to the file actually read, e.g. their decoded copy in the `TileCache`
+    '''
+
+    paths = paths or {}
+
+    positions = [parse_tile_name(os.path.basename(tile)) for tile in tiles]
+
+    min_row = min(position['row'] for position in positions)
+    max_row = max(position['row'] for position in positions)
+    min_col = min(position['col'] for position in positions)
+    max_col = max(position['col'] for position in positions)
+
+    (tile_width, tile_height) = (grid['tile_width'], grid['tile_height'])
+
+    (col_off, row_off) = (0, 0)
+    (x_size, y_size) = ((max_col - min_col + 1) * tile_width, (max_row - min_row + 1) * tile_height)
+
+    if window is not None:
+        (col_off, row_off) = (int(window.col_off), int(window.row_off))
+        (x_size, y_size) = (int(window.width), int(window.height))
+
+    left = grid['left'] + min_col * grid['width'] + col_off * grid['res'][0]
+    top = grid['top'] - min_row * grid['height'] - row_off * grid['res'][1]
+
+    colors = ['Red', 'Green', 'Blue', 'Alpha']
+
+    bands = []
+
+    for (band, index) in enumerate(indexes, start=1):
+        sources = []
+
+        for (tile, position) in zip(tiles, positions):
+            source_band = get_rgba_bands(tile)[index - 1]
+
+            # the tile has no band for it, e.g. the alpha of a RGB tile
+            if not source_band:
+                continue
+
+            x_off = (position['col'] - min_col) * tile_width - col_off
+            y_off = (position['row'] - min_row) * tile_height - row_off
+
+            sources.append(f'''
+      <SimpleSource>
+        <SourceFilename relativeToVRT="0">{escape(paths.get(tile) or os.path.abspath(tile))}</SourceFilename>
+        <SourceBand>{source_band}</SourceBand>
+        <SourceProperties RasterXSize="{tile_width}" RasterYSize="{tile_height}" DataType="Byte" BlockXSize="{tile_width}" BlockYSize="1"/>
+        <SrcRect xOff="0" yOff="0" xSize="{tile_width}" ySize="{tile_height}"/>
+        <DstRect xOff="{x_off}" yOff="{y_off}" xSize="{tile_width}" ySize="{tile_height}"/>
+      </SimpleSource>''')
+
+        bands.append(f'''
+    <VRTRasterBand dataType="Byte" band="{band}">
+      <ColorInterp>{colors[index - 1]}</ColorInterp>{''.join(sources)}
+    </VRTRasterBand>''')
+
+    return f'''<VRTDataset rasterXSize="{x_size}" rasterYSize="{y_size}">
+    <SRS>{escape(CRS.from_string(crs).to_wkt())}</SRS>
+    <GeoTransform>{left!r}, {grid['res'][0]!r}, 0.0, {top!r}, 0.0, {-grid['res'][1]!r}</GeoTransform>{''.join(bands)}
+</VRTDataset>'''
+
+
+def get_partial_path(path):
+    return f'{path[:-4]}.partial.tif'
+
+
+def get_work_path(path):
+    return f'{path[:-4]}.work.tif'
+
+
+def match_tiles(tiles, grid, gdf_cards):
+    '''
+    Finds the cards intersecting each tile with a single query to the cards spatial index.
+    The tiles bounds are computed from the row and column in their names, so they are not opened.
+    Returns the (id_carta, tile) pairs and the cards found, by id
+    '''
+
+    tiles_bounds = []
+
+    for tile in tiles:
+        attributes = parse_tile_name(os.path.basename(tile))
+        left = grid['left'] + attributes['col'] * grid['width']
+        top = grid['top'] - attributes['row'] * grid['height']
+        tiles_bounds.append(box(left, top - grid['height'], left + grid['width'], top))
+
+    sindex = gdf_cards.sindex
+
+    # `query_bulk` was merged into `query` in newer geopandas versions
+    query = getattr(sindex, 'query_bulk', sindex.query)
+
+    (tiles_index, cards_index) = query(gpd.GeoSeries(tiles_bounds), predicate='intersects')
+
+    # read once as plain lists instead of a pandas row per match
+    ids = gdf_cards['caracteristica_de_hoja'].tolist()
+    fajas = gdf_cards['numero_faja'].tolist()
+    geometries = gdf_cards.geometry.to_numpy()
+
+    matches = [(ids[card_index], tiles[tile_index]) for (tile_index, card_index) in zip(tiles_index.tolist(), cards_index.tolist())]
+    cards = {}
+
+    # only the cards found, each one once
+    for card_index in dict.fromkeys(cards_index.tolist()):
+        if ids[card_index] not in cards:
+            cards[ids[card_index]] = {
+                'faja': fajas[card_index],
+                'geom': mapping(geometries[card_index])
+            }
+
+    return (matches, cards)
+
+
+def get_tile_grid(tile):
+    '''
+    Tile matrix origin and tile size, from the georeferencing of a single tile
+    '''
+
+    attributes = parse_tile_name(os.path.basename(tile))
+
+    with rasterio.open(tile) as dst:
+        (left, bottom, right, top) = dst.bounds
+        (tile_width, tile_height) = (dst.width, dst.height)
+        res = dst.res
+
+    width = right - left
+    height = top - bottom
+
+    return {
+        'left': left - attributes['col'] * width,
+        'top': top + attributes['row'] * height,
+        'width': width,
+        'height': height,
+        'tile_width': tile_width,
+        'tile_height': tile_height,
+        'res': res
+    }
+
+
+def parse_tile_name(file_name):
+    '''
+    Reads the attributes encoded in the tile name
+    '''
+
+    attributes = file_name.split('.')[0].split('_')
+
+    return {
+        'crs': [x for x in attributes if 'EPSG' in x][0].replace('-', ':'),
+        'row': int([x for x in attributes if x.startswith('row-')][0][4:]),
+        'col': int([x for x in attributes if x.startswith('col-')][0][4:]),
+        'zoom': int([x for x in attributes if x.startswith('zoom-')][0][5:])
+    }
+
+
+def get_rgba_bands(tile):
+    '''
+    Source band of the tile for each RGBA band, 0 when the tile has nothing for it
+    '''
+
+    if tile not in tiles_bands:
+        with rasterio.open(tile) as dst:
+            number_bands = dst.count
+
+        tiles_bands[tile] = {
+            1: [1, 1, 1, 0],
+            2: [1, 1, 1, 2],
+            3: [1, 2, 3, 0]
+        }.get(number_bands, [1, 2, 3, 4])
+
+    return tiles_bands[tile]
+
+
+def get_blank_tiles(input_folder):
+    '''
+    (row, col) of the tiles found blank by the downloader, read from its manifest next to the zoom folder
+    '''
+
+    manifest_path = os.path.join(os.path.dirname(input_folder), 'manifest.sqlite')
+
+    if not os.path.exists(manifest_path):
+        return set()
+
+    zoom = int(os.path.basename(input_folder))
+
+    connection = sqlite3.connect(manifest_path)
+
+    try:
+        return set(connection.execute('SELECT row, col FROM tiles WHERE zoom = ? AND empty = 1', (zoom,)))
+    except sqlite3.OperationalError:
+        # manifest of an older version, without the `empty` column
+        return set()
+    finally:
+        connection.close()
+
+
+def get_tile_position(tile):
+    attributes = parse_tile_name(os.path.basename(tile))
+    return (attributes['row'], attributes['col'])
+
+
+def calculate_epsg(faja):
+    if faja == '1':
+        dst_crs = 'EPSG:5343'
+    elif faja == '2':
+        dst_crs = 'EPSG:5344'
+    elif faja == '3':
+        dst_crs = 'EPSG:5345'
+    elif faja == '4':
+        dst_crs = 'EPSG:5346'
+    elif faja == '5':
+        dst_crs = 'EPSG:5347'
+    elif faja == '6':
+        dst_crs = 'EPSG:5348'
+    elif faja == '7':
+        dst_crs = 'EPSG:5349'
+    else:
+        dst_crs = None
+
+    return dst_crs
+
+
+def iter_images(input_folder):
+    '''
+    Paths of the tiles in the folder, listed as they are read instead of all at once
+    '''
+
+    extensions = ('.png', '.jpg', '.jpeg', '.tiff', '.tif')
+
+    with os.scandir(input_folder) as entries:
+        for entry in entries:
+            if entry.name.endswith(extensions) and entry.is_file():
+                yield f'{input_folder}/{entry.name}'
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
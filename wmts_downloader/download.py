@@ -0,0 +1,256 @@
+import os
+import importlib.util
+import requests
+from colorama import Fore, Style
+
+from .capabilities import TileLayer, create_session
+from .planning import load_aoi, plan_tile_array, subtract_tiles, contains_tiles, is_parent_matrix, order_tiles, iter_tiles, get_shard_mask
+from .fetching import RateLimiter, TileHashes, download_tiles, get_tile, metrics
+from .manifest import Manifest, LeaseCoordinator, iter_leased_tiles, import_existing_tiles
+from .stores import FileStore, MBTilesStore, GeoPackageStore, CogStore, is_empty_tile
+
+
+def download_layer(url, layer_id, zooms, output_folder='output', format='image/png', proj='EPSG:3857', bbox=None, aoi=None, order='row',
+                   workers=1, pool_size=None, timeout=30, store_type='files', limit_requests=0, remove_old=False, refresh=False, skip_empty=False,
+                   rate=10, max_rate=0, sleep=0, max_retries=5, capabilities_ttl=86400, shard=None, lease=False, lease_size=32, lease_ttl=60):
+    '''
+    Downloads the zoom levels of a layer into `{output_folder}/{layer_id}/{proj}`, resuming from its manifest.
+    `aoi` is the path of a GeoJSON file and `shard` an (index, count) tuple, counting from 0.
+    Returns the counts of the job, or None if the server can't be reached
+    '''
+
+    if refresh and store_type == 'cog':
+        raise Exception('`--refresh` is not available for the `cog` store, the mosaic must be downloaded again with `--removeold`')
+
+    if shard and lease:
+        raise Exception('`--shard` and `--lease` can\'t be used together')
+
+    if (shard or lease) and store_type == 'cog':
+        raise Exception('The `cog` store can\'t be written by several processes, use `--shard` and `--lease` with another store')
+
+    # blank tiles are detected decoding them, only if rasterio is available
+    if importlib.util.find_spec('rasterio'):
+        is_empty = is_empty_tile
+    elif skip_empty:
+        raise Exception('`--skip-empty` requires rasterio')
+    else:
+        is_empty = None
+
+    workers = max(1, workers)
+    pool_size = pool_size or workers
+
+    if sleep:
+        max_rate = min(max_rate, 1 / sleep) if max_rate else 1 / sleep
+
+    rate_limiter = RateLimiter(rate, max_rate=max_rate)
+
+    summary = {
+        'downloaded': 0,
+        'requests': 0,
+        'skipped': 0,
+        'empty': 0,
+        'unchanged': 0,
+        'saved': 0,
+        'duplicates': 0,
+        'referenced': 0,
+        'done': 0,
+        'total': 0,
+        'failed': []
+    }
+
+    # other processes of the same job may be creating it too
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    print(f'Connecting to server: {url}')
+
+    try:
+        tile_layer = TileLayer(url, layer_id, proj, format, f'{output_folder}/capabilities', capabilities_ttl, timeout)
+    except requests.exceptions.RequestException:
+        print(f"{Fore.RED}-> Can't connect to server{Style.RESET_ALL}")
+        return None
+
+    layer = tile_layer.layer
+
+    print(f'{Fore.GREEN}-> Connection successful{Style.RESET_ALL}')
+    print(f'-> Title: {tile_layer.wmts.identification.title}')
+    print(f'-> Access constraints: {tile_layer.wmts.identification.accessconstraints}')
+
+    print('\t')
+
+    print(f'-> Layer {layer_id} found')
+    print(f'--> Title: {layer.title}')
+    print(f'--> Abstract: {layer.abstract}')
+    print(f'--> Bounding Box WGS84: {layer.boundingBoxWGS84}')
+    print(f'--> Available formats: {layer.formats}')
+    print(f'--> Available tile matrix sets: {layer._tilematrixsets}')
+
+    layer_folder = f'{output_folder}/{layer_id}/{proj.replace(":", "-")}'
+
+    if not os.path.exists(layer_folder):
+        os.makedirs(layer_folder, exist_ok=True)
+
+    # each store keeps its own manifest, as the tiles saved in one are not in the others
+    manifest_name = 'manifest' if store_type == 'files' else f'manifest-{store_type}'
+    manifest = Manifest(f'{layer_folder}/{manifest_name}.sqlite')
+
+    # the processes sharing the job coordinate through the same database
+    coordinator = LeaseCoordinator(f'{layer_folder}/{manifest_name}.sqlite', lease_ttl) if lease else None
+
+    extension = format.split('/')[-1]
+    file_prefix = f'{layer_id}__{proj.replace(":", "-")}'
+
+    aoi = load_aoi(aoi, proj) if aoi else None
+
+    # the capabilities are read only once, then every tile of every zoom goes through the same pooled session
+    session = create_session(pool_size)
+
+    try:
+        for zoom in zooms:
+
+            if zoom not in tile_layer.limits:
+                print(f'{Fore.YELLOW}-> Zoom {zoom} is not in the tile matrix set{Style.RESET_ALL}')
+                continue
+
+            if limit_requests and summary['requests'] >= limit_requests:
+                break
+
+            matrix = tile_layer.get_matrix(zoom)
+            zoom_folder = f'{layer_folder}/{zoom}'
+            tile_key = (layer_id, proj, zoom)
+
+            print('\t')
+            print(f'Downloading images of zoom {zoom}...')
+
+            with metrics.timer('plan'):
+                planned_tiles = plan_tile_array(matrix, tile_layer.get_tiles_range(zoom, bbox), aoi)
+
+            zoom_tiles = len(planned_tiles)
+            summary['total'] += zoom_tiles
+
+            if not zoom_tiles:
+                print(f'{Fore.YELLOW}-> No tiles intersect the area of interest{Style.RESET_ALL}')
+                continue
+
+            # the mosaic only covers the planned tiles
+            (min_row, min_col) = planned_tiles.min(axis=0).tolist()
+            (max_row, max_col) = (planned_tiles.max(axis=0) + 1).tolist()
+
+            if store_type == 'mbtiles':
+                tile_store = MBTilesStore(f'{layer_folder}/{layer_id}.mbtiles', layer, format, matrix, zoom)
+            elif store_type == 'gpkg':
+                tile_store = GeoPackageStore(f'{layer_folder}/{layer_id}.gpkg', layer, proj, matrix, zoom)
+            elif store_type == 'cog':
+                tile_store = CogStore(f'{layer_folder}/{file_prefix}_zoom-{zoom}.tif', proj, matrix, (min_row, max_row, min_col, max_col), remove_old)
+            else:
+                tile_store = FileStore(zoom_folder, file_prefix, extension, matrix, zoom)
+
+            if remove_old:
+                print('Removing old files...')
+                # the mosaic was already removed before being opened again
+                if store_type != 'cog':
+                    tile_store.clear()
+                manifest.remove(*tile_key)
+
+            # a new mosaic has none of the tiles of the old one
+            elif store_type == 'cog' and tile_store.created:
+                manifest.remove(*tile_key)
+
+            # tiles downloaded before the manifest existed
+            if store_type == 'files' and not manifest.count(*tile_key):
+                imported = import_existing_tiles(manifest, tile_key, zoom_folder, file_prefix, extension)
+                if imported:
+                    print(f'-> Imported {imported} existing tiles into the manifest')
+
+            # a single query and a bulk subtraction instead of checking each tile
+            if refresh:
+                with metrics.timer('plan'):
+                    tiles = subtract_tiles(planned_tiles, manifest.get_tiles(*tile_key, status='skipped'))
+
+                print(f'-> Planned tiles: {zoom_tiles} ({len(manifest.get_tiles(*tile_key))} to check for changes)')
+            else:
+                with metrics.timer('plan'):
+                    tiles = subtract_tiles(planned_tiles, manifest.get_tiles(*tile_key, status=('done', 'skipped')))
+
+                summary['skipped'] += zoom_tiles - len(tiles)
+
+                print(f'-> Planned tiles: {zoom_tiles} ({zoom_tiles - len(tiles)} already downloaded)')
+
+            # the children of empty tiles are empty too, and are not requested
+            if skip_empty and (zoom - 1) in tile_layer.limits and is_parent_matrix(tile_layer.get_matrix(zoom - 1), matrix):
+                empty_parents = manifest.get_empty_tiles(layer_id, proj, zoom - 1)
+                empty_children = tiles[contains_tiles(tiles // 2, empty_parents)]
+
+                if len(empty_children):
+                    manifest.set_skipped(*tile_key, empty_children)
+                    tiles = subtract_tiles(tiles, empty_children)
+                    summary['empty'] += len(empty_children)
+
+                    print(f'-> Skipped tiles with an empty parent: {len(empty_children)}')
+
+            if shard:
+                tiles = tiles[get_shard_mask(tiles, *shard)]
+
+                print(f'-> Shard {shard[0] + 1}/{shard[1]}: {len(tiles)} tiles')
+
+            tiles = order_tiles(tiles, order)
+
+            # the whole zoom at once, or block by block as they are leased
+            if coordinator:
+                batches = iter_leased_tiles(coordinator, manifest, tile_key, tiles, lease_size, 'skipped' if refresh else ('done', 'skipped'))
+            else:
+                batches = iter([tiles])
+
+            tile_url = tile_layer.get_tile_url(zoom)
+
+            print(f'-> Tile url: {tile_url}')
+
+            def fetch(row, col, validators):
+                return get_tile(session, tile_url, row, col, timeout, validators)
+
+            # the contents already saved more than once are known from the start
+            tile_hashes = TileHashes(manifest.get_repeated_checksums(*tile_key))
+
+            try:
+                for batch_tiles in batches:
+                    (batch_download_count, batch_unchanged_count, batch_failed) = download_tiles(iter_tiles(batch_tiles), fetch, manifest, tile_key, tile_store, workers,
+                        limit_requests - summary['requests'] if limit_requests else 0, rate_limiter, max_retries, tile_hashes, is_empty=is_empty, refresh=refresh)
+
+                    summary['downloaded'] += batch_download_count
+                    summary['unchanged'] += batch_unchanged_count
+                    summary['failed'] += batch_failed
+                    summary['requests'] += batch_download_count + batch_unchanged_count + len(batch_failed)
+
+                    # a leased block that was not finished is returned
+                    if limit_requests and summary['requests'] >= limit_requests:
+                        break
+            finally:
+                if coordinator:
+                    batches.close()
+                tile_store.close()
+
+            summary['saved'] += tile_hashes.count
+            summary['duplicates'] += tile_hashes.duplicates
+
+            # only some stores save the duplicated tiles once
+            if tile_store.deduplicated:
+                summary['referenced'] += tile_hashes.duplicates
+
+            summary['done'] += zoom_tiles - len(subtract_tiles(planned_tiles, manifest.get_tiles(*tile_key, status=('done', 'skipped'))))
+
+            if store_type == 'cog':
+                # the work file is kept while any tile is missing or failed, so a rerun only requests those
+                if not len(subtract_tiles(planned_tiles, manifest.get_tiles(*tile_key, status=('done', 'skipped')))):
+                    print('-> Writing Cloud Optimized GeoTIFF...')
+                    tile_store.finalize()
+                    print(f'{Fore.GREEN}-> Mosaic saved: {tile_store.path}{Style.RESET_ALL}')
+                else:
+                    print('-> The Cloud Optimized GeoTIFF will be written when all the tiles are downloaded')
+
+    finally:
+        session.close()
+        manifest.close()
+        if coordinator:
+            coordinator.close()
+
+    return summary
@@ -0,0 +1,508 @@
+import time
+import heapq
+import random
+import hashlib
+import threading
+import collections
+import requests
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from colorama import Fore, Style
+
+from .metrics import Metrics
+
+# shared by all the downloads of the process
+metrics = Metrics('wmts_downloader')
+
+
+class TileError(Exception):
+    '''
+    Error requesting a tile. `throttle` signals that the server is overloaded
+    '''
+
+    def __init__(self, message, retryable=True, throttle=False, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.throttle = throttle
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by all the workers. Its rate is tuned with AIMD: it grows after each
+    fast response (doubling every second until the first slowdown, then by `increase` per second),
+    and it is cut when the server pushes back (429/503, timeouts) or when the latency climbs
+    well above the best one observed
+    '''
+
+    def __init__(self, rate, min_rate=0.5, max_rate=None, increase=1, decrease=0.7, cooldown=1):
+        self.rate = rate if not max_rate else min(rate, max_rate)
+        self.min_rate = min_rate if not max_rate else min(min_rate, max_rate)
+        self.max_rate = max_rate
+        self.increase = increase # requests per second added after each second of fast responses
+        self.decrease = decrease
+        self.cooldown = cooldown # minimum seconds between two decreases
+
+        self.lock = threading.Lock()
+        self.tokens = 1
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.slow_start = True
+        self.last_decrease = 0
+        self.last_wait = 0
+        self.latency = None # moving average
+        self.base_latency = None
+
+    def acquire(self):
+        '''
+        Blocks until a request can be sent
+        '''
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                # the bucket holds a single token, so the requests are evenly spaced
+                self.tokens = min(1, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                self.last_wait = now
+
+            time.sleep(delay)
+
+    def success(self, latency):
+        with self.lock:
+            self.latency = latency if self.latency is None else self.latency * 0.9 + latency * 0.1
+            self.base_latency = self.latency if self.base_latency is None else min(self.base_latency, self.latency)
+
+            if self.latency > self.base_latency * 3 + 0.05:
+                self._decrease()
+
+            # only speed up if the limiter is what is holding the workers back
+            elif time.monotonic() - self.last_wait < 1:
+                # spread over the requests sent in a second
+                self.rate += 1 if self.slow_start else self.increase / self.rate
+                if self.max_rate:
+                    self.rate = min(self.rate, self.max_rate)
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+
+        # many requests in flight fail together, only react once to them
+        if now - self.last_decrease < self.cooldown:
+            return
+
+        self.slow_start = False
+        self.last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class TileHashes:
+    '''
+    Checksums of the tiles saved, to find the ones with the same content. The repeated checksums
+    are all kept, but only the last `max_unique` seen once, so the memory doesn't grow with the job
+    '''
+
+    def __init__(self, repeated=None, max_unique=100000):
+        self.lock = threading.Lock()
+        self.unique = collections.OrderedDict()
+        self.repeated = dict(repeated or {})
+        self.max_unique = max_unique
+        self.count = 0
+        self.duplicates = 0
+
+    def add(self, checksum, row, col):
+        '''
+        Returns the (row, col) of a previous tile with the same checksum, or None
+        '''
+
+        with self.lock:
+            self.count += 1
+
+            original = self.repeated.get(checksum)
+
+            if original is None:
+                original = self.unique.pop(checksum, None)
+
+                if original is None:
+                    self.unique[checksum] = (row, col)
+                    if len(self.unique) > self.max_unique:
+                        self.unique.popitem(last=False)
+                    return None
+
+                self.repeated[checksum] = original
+
+            self.duplicates += 1
+
+            return original
+
+
+def fetch_tiles(tiles, fetch, workers=1, rate_limiter=None, max_retries=5, limit_requests=0, handle=None, get_validators=None, report=None):
+    '''
+    Requests the tiles keeping up to `workers` requests in flight, and yields `(row, col, result, error)`
+    as they finish. The tiles are only taken from `tiles` when there is room in the queue, and no more
+    requests are sent while the yielded results are not consumed, so both ends stay bounded.
+    `fetch(row, col, validators)` returns the response, which is passed to `handle(row, col, response, validators)`
+    in the worker; by default the whole content is read. Failed tiles are retried with a jittered
+    exponential backoff, and only yielded with their error once they can't be retried anymore.
+    Other errors raised by `handle` fail the tile without retrying it.
+    `get_validators(row, col)` and `report(event, row, col, **details)` are called from the consuming thread,
+    the latter when a tile is requested, retried, delayed or given up (`request`, `retry`, `backoff`, `failed`)
+    '''
+
+    rate_limiter = rate_limiter or RateLimiter(10)
+    handle = handle or read_response
+    get_validators = get_validators or (lambda row, col: None)
+    report = report or (lambda event, row, col, **details: None)
+
+    request_count = 0
+
+    # future -> (row, col, attempt, validators)
+    pending = {}
+
+    # heap of (due time, attempt, row, col)
+    retries = []
+
+    tiles = iter(tiles)
+    tiles_exhausted = False
+
+    def fetch_tile(row, col, validators):
+        with metrics.timer('throttle'):
+            rate_limiter.acquire()
+
+        start = time.monotonic()
+
+        try:
+            response = fetch(row, col, validators)
+        except TileError as error:
+            if error.throttle:
+                rate_limiter.throttle(error.retry_after)
+            raise
+        finally:
+            metrics.observe('request', time.monotonic() - start)
+
+        rate_limiter.success(time.monotonic() - start)
+
+        if response.status_code == 304:
+            response.close()
+            return {'unchanged': True, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+        try:
+            return handle(row, col, response, validators)
+        except requests.exceptions.RequestException as error:
+            raise TileError(f'Connection error: {error}', throttle=True)
+        except TileError:
+            raise
+        except Exception as error:
+            # e.g. a body that can't be decoded, the tile fails without stopping the others
+            raise TileError(f'Tile not saved: {error!r}', retryable=False)
+
+    def next_task():
+        nonlocal tiles_exhausted, request_count
+
+        if retries and retries[0][0] <= time.monotonic():
+            (_, attempt, row, col) = heapq.heappop(retries)
+            report('retry', row, col, attempt=attempt + 1)
+            return (row, col, attempt, get_validators(row, col))
+
+        while not tiles_exhausted:
+
+            if limit_requests and request_count >= limit_requests:
+                tiles_exhausted = True
+                break
+
+            try:
+                (row, col) = next(tiles)
+            except StopIteration:
+                tiles_exhausted = True
+                break
+
+            request_count += 1
+
+            validators = get_validators(row, col)
+
+            report('request', row, col, count=request_count, validators=validators)
+
+            return (row, col, 0, validators)
+
+        return None
+
+    # named, to find them in py-spy
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile')
+
+    try:
+        while True:
+
+            # keep the queue bounded, so the tiles are not all loaded in memory at once
+            while len(pending) < workers * 2:
+                task = next_task()
+                if not task:
+                    break
+                (row, col, attempt, validators) = task
+                pending[executor.submit(fetch_tile, row, col, validators)] = task
+
+            if not pending:
+                if not retries:
+                    break
+                time.sleep(max(0, retries[0][0] - time.monotonic()))
+                continue
+
+            # wake up when the next retry is due, even if no request has finished
+            wait_timeout = max(0, retries[0][0] - time.monotonic()) if retries else None
+
+            done, _ = wait(pending, timeout=wait_timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                (row, col, attempt, validators) = pending.pop(future)
+
+                metrics.count('requests')
+
+                try:
+                    result = future.result()
+                except TileError as error:
+                    metrics.count('errors')
+                    if error.throttle:
+                        metrics.count('throttled')
+
+                    if not error.retryable or attempt >= max_retries:
+                        report('failed', row, col, error=error)
+                        yield (row, col, None, error)
+                        continue
+
+                    delay = get_retry_delay(attempt, error.retry_after)
+
+                    report('backoff', row, col, delay=delay, error=error)
+
+                    heapq.heappush(retries, (time.monotonic() + delay, attempt + 1, row, col))
+                    metrics.count('retries')
+                    continue
+
+                yield (row, col, result, None)
+
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def read_response(row, col, response, validators=None):
+    '''
+    Default handler of `fetch_tiles`, reads the whole tile in memory
+    '''
+
+    with metrics.timer('receive'):
+        content = response.content
+
+    return {
+        'content': content,
+        'bytes': len(content),
+        'checksum': hashlib.sha256(content).hexdigest(),
+        'http_status': response.status_code,
+        'content_type': response.headers.get('Content-Type'),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified')
+    }
+
+
+def download_tiles(tiles, fetch, manifest, tile_key, tile_store, workers, limit_requests, rate_limiter, max_retries, tile_hashes, commit_every=100, is_empty=None, refresh=False):
+    '''
+    Downloads the tiles with `fetch_tiles`, saving each one into the store from the worker as soon
+    as the response arrives, and recording it as done in the manifest once the store has saved it.
+    The tiles already downloaded must be left out by the planner. Tiles with the same content
+    as a previous one are saved by reference when the store allows it, and with `is_empty`
+    the repeated contents are checked once to record which ones are blank.
+    With `refresh`, the tiles already downloaded are requested again with their validators
+    (ETag, Last-Modified), and only the ones that changed are saved again
+    '''
+
+    zoom = tile_key[2]
+
+    download_count = 0
+    unchanged_count = 0
+    failed = []
+
+    # the store saves the responses by chunks
+    streamed = hasattr(tile_store, 'receive')
+
+    def save_tile(row, col, response, validators):
+        with metrics.timer('receive'):
+            if streamed:
+                # written to a temporary file as it arrives, the tile is never fully in memory
+                (img, checksum, size) = tile_store.receive(row, col, response.iter_content(chunk_size=65536))
+            else:
+                img = response.content
+                (checksum, size) = (hashlib.sha256(img).hexdigest(), len(img))
+
+        # the server ignored the validators, but the content is the same
+        if validators and checksum == validators['checksum']:
+            if streamed:
+                tile_store.discard(img)
+            return {'unchanged': True, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+
+        # only the tiles written are counted. Blank tiles are always the same bytes, so only the repeated ones are checked
+        original = tile_hashes.add(checksum, row, col)
+
+        # a content found blank before is blank in every zoom level, even if it is not repeated in this one
+        if checksum in manifest.blank_checksums:
+            empty = True
+        else:
+            empty = is_empty(img, checksum) if is_empty and original else None
+
+        with metrics.timer('write'):
+            tile_store.write(row, col, img, checksum, original, empty)
+
+        return {
+            'bytes': size,
+            'checksum': checksum,
+            'empty': empty,
+            'http_status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+
+    def get_validators(row, col):
+        # read by the consuming thread, the manifest connection is not shared with the workers
+        return manifest.get_validators(*tile_key, row, col) if refresh else None
+
+    def report(event, row, col, **details):
+        position = f'Column {col} - Row {row} - Zoom {zoom}'
+
+        if event == 'request':
+            print(f'--> {"Checking" if details["validators"] else "Downloading"} tile ({details["count"]}): {position}')
+        elif event == 'retry':
+            print(f'--> Retrying tile (attempt {details["attempt"]}): {position}')
+        elif event == 'backoff':
+            print(f'{Fore.YELLOW}--> Tile will be retried in {details["delay"]:.1f}s: {position} ({details["error"]}){Style.RESET_ALL}')
+        elif event == 'failed':
+            print(f'{Fore.RED}--> Failed tile: {position} ({details["error"]}){Style.RESET_ALL}')
+
+    results = fetch_tiles(tiles, fetch, workers, rate_limiter, max_retries, limit_requests, save_tile, get_validators, report)
+
+    try:
+        for (row, col, info, error) in results:
+
+            if error:
+                manifest.set_failed(*tile_key, row, col, str(error))
+                failed.append((row, col))
+                metrics.count('tiles_failed')
+
+            elif info.get('unchanged'):
+                manifest.set_checked(*tile_key, row, col, info['etag'], info['last_modified'])
+                unchanged_count += 1
+                metrics.count('tiles_unchanged')
+
+            else:
+                # found blank by another tile while this one was being saved
+                if info['empty'] is None and info['checksum'] in manifest.blank_checksums:
+                    info['empty'] = True
+
+                manifest.set_done(*tile_key, row, col, info)
+                download_count += 1
+                metrics.count('tiles_downloaded')
+                metrics.count('bytes', info['bytes'])
+
+                if info['empty']:
+                    manifest.add_blank_checksum(info['checksum'], *tile_key)
+
+            # the tiles must be saved before the manifest marks them as done
+            if manifest.uncommitted >= commit_every:
+                with metrics.timer('commit'):
+                    tile_store.flush()
+                    manifest.commit()
+
+    finally:
+        # waits for the requests in flight, before the last tiles are saved
+        results.close()
+        with metrics.timer('commit'):
+            tile_store.flush()
+            manifest.commit()
+
+    return (download_count, unchanged_count, failed)
+
+
+def get_retry_delay(attempt, retry_after=None, base=1, cap=120):
+    '''
+    Exponential backoff with full jitter, never shorter than the server `Retry-After`
+    '''
+
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+
+    if retry_after:
+        delay = max(delay, retry_after)
+
+    return delay
+
+
+def get_tile(session, tile_url, row, col, timeout, validators=None):
+    '''
+    Requests a single tile and returns its content. With the `validators` of a previous
+    download, the request is conditional and the server may answer 304 (not modified)
+    '''
+
+    tile_url = tile_url.replace('{TileRow}', str(row)).replace('{TileCol}', str(col))
+
+    headers = {}
+
+    if validators:
+        if validators['etag']:
+            headers['If-None-Match'] = validators['etag']
+        if validators['last_modified']:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    try:
+        # the body is read by the caller, so it can be streamed
+        response = session.get(tile_url, timeout=timeout, headers=headers, stream=True)
+    except requests.exceptions.Timeout:
+        raise TileError('Timeout', throttle=True)
+    except requests.exceptions.ConnectionError as error:
+        raise TileError(f'Connection error: {error}', throttle=True)
+
+    if response.status_code in (429, 503):
+        response.close()
+        raise TileError(f'HTTP {response.status_code}', throttle=True, retry_after=parse_retry_after(response))
+
+    if response.status_code >= 500:
+        response.close()
+        raise TileError(f'HTTP {response.status_code}')
+
+    if response.status_code >= 400:
+        response.close()
+        raise TileError(f'HTTP {response.status_code}', retryable=False)
+
+    # servers usually answer errors with a 200 and a xml exception report
+    if 'xml' in response.headers.get('Content-Type', ''):
+        raise TileError(f'Server error: {response.text}', retryable=False)
+
+    return response
+
+
+def parse_retry_after(response):
+    '''
+    Returns the `Retry-After` header in seconds, if any
+    '''
+
+    retry_after = response.headers.get('Retry-After')
+
+    if not retry_after:
+        return None
+
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(retry_after)
+        return max(0, date.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,445 @@
+import os
+import time
+import socket
+import sqlite3
+import itertools
+import threading
+import numpy as np
+from colorama import Fore, Style
+
+from .planning import subtract_tiles
+
+
+class Manifest:
+    '''
+    Persistent state of every tile, stored in a SQLite database (WAL mode). A tile is only
+    marked as done after its files were completely written, so resuming is a single query
+    and interrupted writes are downloaded again
+    '''
+
+    def __init__(self, path):
+        # several processes can share it, each one waits while another commits
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                layer TEXT NOT NULL,
+                tilematrixset TEXT NOT NULL,
+                zoom INTEGER NOT NULL,
+                row INTEGER NOT NULL,
+                col INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                bytes INTEGER,
+                checksum TEXT,
+                http_status INTEGER,
+                content_type TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                empty INTEGER,
+                error TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (layer, tilematrixset, zoom, row, col)
+            ) WITHOUT ROWID
+        ''')
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS blank_checksums (checksum TEXT PRIMARY KEY) WITHOUT ROWID')
+
+        # manifests created by older versions
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(tiles)')]
+        if 'empty' not in columns:
+            self.connection.execute('ALTER TABLE tiles ADD COLUMN empty INTEGER')
+
+        self.connection.commit()
+
+        # the writes are kept until the commit, so the database is only locked for a moment
+        self.pending = []
+        self.uncommitted = 0
+
+        # the blank contents found by previous runs are known from the start
+        self.blank_checksums = {checksum for (checksum,) in self.connection.execute('SELECT checksum FROM blank_checksums')}
+        self.blank_zooms = set()
+
+    def get_tiles(self, layer, tilematrixset, zoom, status='done', min_row=None, max_row=None, min_col=None, max_col=None):
+        '''
+        Array of (row, col) of the tiles with the status (or any of a list of status),
+        read without building a python tuple for each one
+        '''
+
+        statuses = [status] if isinstance(status, str) else list(status)
+
+        query = f'SELECT row, col FROM tiles WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND status IN ({", ".join("?" * len(statuses))})'
+        params = [layer, tilematrixset, zoom, *statuses]
+
+        if min_row is not None:
+            query += ' AND row BETWEEN ? AND ? AND col BETWEEN ? AND ?'
+            params += [min_row, max_row, min_col, max_col]
+
+        return self._to_array(self.connection.execute(query, params))
+
+    def get_empty_tiles(self, layer, tilematrixset, zoom):
+        '''
+        Array of (row, col) of the tiles known to be empty, downloaded or skipped
+        '''
+
+        cursor = self.connection.execute(
+            'SELECT row, col FROM tiles WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND empty = 1',
+            (layer, tilematrixset, zoom))
+        return self._to_array(cursor)
+
+    def get_repeated_checksums(self, layer, tilematrixset, zoom):
+        '''
+        Checksum -> (row, col) of one of the tiles, of the contents saved more than once.
+        SQLite takes the row and col of the same tile of each group
+        '''
+
+        cursor = self.connection.execute(
+            '''SELECT checksum, row, col FROM tiles
+            WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND status = 'done' AND checksum IS NOT NULL
+            GROUP BY checksum HAVING COUNT(*) > 1''',
+            (layer, tilematrixset, zoom))
+        return {checksum: (row, col) for (checksum, row, col) in cursor}
+
+    def add_blank_checksum(self, checksum, layer, tilematrixset, zoom):
+        '''
+        Records a blank content, and marks as empty the tiles saved with it before it was known,
+        once per zoom level
+        '''
+
+        if (checksum, layer, tilematrixset, zoom) in self.blank_zooms:
+            return
+
+        self.blank_zooms.add((checksum, layer, tilematrixset, zoom))
+
+        if checksum not in self.blank_checksums:
+            self.blank_checksums.add(checksum)
+
+            # the tiles of the previous zoom levels too
+            self._write('INSERT OR IGNORE INTO blank_checksums (checksum) VALUES (?)', (checksum,))
+            self._write("UPDATE tiles SET empty = 1 WHERE checksum = ? AND status = 'done'", (checksum,))
+            return
+
+        self._write(
+            "UPDATE tiles SET empty = 1 WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND checksum = ? AND status = 'done'",
+            (layer, tilematrixset, zoom, checksum))
+
+    def _to_array(self, cursor):
+        return np.fromiter(itertools.chain.from_iterable(cursor), dtype='int64').reshape(-1, 2)
+
+    def count(self, layer, tilematrixset, zoom, status='done', min_row=None, max_row=None, min_col=None, max_col=None):
+        query = 'SELECT COUNT(*) FROM tiles WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND status = ?'
+        params = [layer, tilematrixset, zoom, status]
+
+        if min_row is not None:
+            query += ' AND row BETWEEN ? AND ? AND col BETWEEN ? AND ?'
+            params += [min_row, max_row, min_col, max_col]
+
+        return self.connection.execute(query, params).fetchone()[0]
+
+    def set_done(self, layer, tilematrixset, zoom, row, col, info):
+        self._write(
+            '''INSERT OR REPLACE INTO tiles
+            (layer, tilematrixset, zoom, row, col, status, bytes, checksum, http_status, content_type, etag, last_modified, empty, error, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, ?)''',
+            (layer, tilematrixset, zoom, row, col, 'done', info.get('bytes'), info.get('checksum'), info.get('http_status'),
+             info.get('content_type'), info.get('etag'), info.get('last_modified'), info.get('empty'), time.time()))
+
+    def set_skipped(self, layer, tilematrixset, zoom, tiles):
+        '''
+        Marks the tiles as empty without downloading them
+        '''
+
+        updated = time.time()
+        self._write_many(
+            '''INSERT OR REPLACE INTO tiles (layer, tilematrixset, zoom, row, col, status, empty, updated)
+            VALUES (?, ?, ?, ?, ?, ?, 1, ?)''',
+            [(layer, tilematrixset, zoom, row, col, 'skipped', updated) for (row, col) in tiles.tolist()])
+        self.commit()
+
+    def get_validators(self, layer, tilematrixset, zoom, row, col):
+        '''
+        ETag, Last-Modified and checksum of a downloaded tile, or None
+        '''
+
+        validators = self.connection.execute(
+            '''SELECT etag, last_modified, checksum FROM tiles
+            WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND row = ? AND col = ? AND status = ?''',
+            (layer, tilematrixset, zoom, row, col, 'done')).fetchone()
+
+        if not validators:
+            return None
+
+        return dict(zip(('etag', 'last_modified', 'checksum'), validators))
+
+    def set_checked(self, layer, tilematrixset, zoom, row, col, etag, last_modified):
+        '''
+        Records that a tile didn't change, keeping its validators if the server sent none
+        '''
+
+        self._write(
+            '''UPDATE tiles SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), updated = ?
+            WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND row = ? AND col = ?''',
+            (etag, last_modified, time.time(), layer, tilematrixset, zoom, row, col))
+
+    def set_failed(self, layer, tilematrixset, zoom, row, col, error):
+        self._write(
+            '''INSERT OR REPLACE INTO tiles (layer, tilematrixset, zoom, row, col, status, error, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+            (layer, tilematrixset, zoom, row, col, 'failed', error, time.time()))
+
+    def remove(self, layer, tilematrixset, zoom):
+        self.connection.execute(
+            'DELETE FROM tiles WHERE layer = ? AND tilematrixset = ? AND zoom = ?',
+            (layer, tilematrixset, zoom))
+        self.connection.commit()
+
+    def _write(self, query, params):
+        self._write_many(query, [params])
+
+    def _write_many(self, query, rows):
+        self.pending.append((query, rows))
+        self.uncommitted += len(rows)
+
+    def commit(self):
+        # a single short transaction for all the writes since the last commit
+        with self.connection:
+            for (query, rows) in self.pending:
+                self.connection.executemany(query, rows)
+
+        self.pending = []
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class LeaseCoordinator:
+    '''
+    Shares a job between several processes, in one or several machines, through a table of the
+    manifest. The tiles are split in square blocks, and each process leases the next free block,
+    downloads it and marks it as done. A heartbeat renews the lease while the block is downloaded,
+    so the blocks of a process that stopped are leased again by the others once they expire
+    '''
+
+    def __init__(self, path, ttl=60):
+        # the transactions are started explicitly, to lease each block atomically
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                layer TEXT NOT NULL,
+                tilematrixset TEXT NOT NULL,
+                zoom INTEGER NOT NULL,
+                block_row INTEGER NOT NULL,
+                block_col INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL,
+                done INTEGER NOT NULL,
+                PRIMARY KEY (layer, tilematrixset, zoom, block_row, block_col)
+            ) WITHOUT ROWID
+        ''')
+
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl
+        self.lease = None
+        self.lock = threading.Lock()
+
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+
+    def reset(self, tile_key):
+        '''
+        Removes the leases of a previous run, once all its blocks were done
+        '''
+
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            (count, done) = self.connection.execute(
+                'SELECT COUNT(*), SUM(done) FROM leases WHERE layer = ? AND tilematrixset = ? AND zoom = ?', tile_key).fetchone()
+
+            if count and count == done:
+                self.connection.execute('DELETE FROM leases WHERE layer = ? AND tilematrixset = ? AND zoom = ?', tile_key)
+
+    def acquire(self, tile_key, blocks):
+        '''
+        Leases the first block of the list that is not done nor leased by a live process,
+        returns its index or None
+        '''
+
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            now = time.time()
+            taken = set(self.connection.execute(
+                '''SELECT block_row, block_col FROM leases
+                WHERE layer = ? AND tilematrixset = ? AND zoom = ? AND (done = 1 OR expires > ?)''',
+                (*tile_key, now)))
+
+            for (index, block) in enumerate(blocks):
+                if block in taken:
+                    continue
+
+                self.connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?, ?, ?, ?, 0)',
+                                        (*tile_key, *block, self.owner, now + self.ttl))
+                self.lease = (*tile_key, *block)
+
+                return index
+
+        return None
+
+    def get_next_expiry(self, tile_key, blocks):
+        '''
+        Time at which the first block of the list leased by another process expires, the current
+        time if one is free, or None if all of them are done
+        '''
+
+        with self.lock:
+            leases = {(block_row, block_col): (expires, done) for (block_row, block_col, expires, done) in self.connection.execute(
+                'SELECT block_row, block_col, expires, done FROM leases WHERE layer = ? AND tilematrixset = ? AND zoom = ?', tile_key)}
+
+        now = time.time()
+        next_expiry = None
+
+        for block in blocks:
+            (expires, done) = leases.get(block, (now, 0))
+
+            if not done:
+                next_expiry = expires if next_expiry is None else min(next_expiry, expires)
+
+        return next_expiry
+
+    def release(self, done):
+        '''
+        Marks the leased block as done, or returns it so another process can lease it
+        '''
+
+        with self.lock:
+            if not self.lease:
+                return
+
+            if done:
+                self.connection.execute(
+                    '''UPDATE leases SET done = 1 WHERE layer = ? AND tilematrixset = ? AND zoom = ?
+                    AND block_row = ? AND block_col = ? AND owner = ?''', (*self.lease, self.owner))
+            else:
+                self.connection.execute(
+                    '''DELETE FROM leases WHERE layer = ? AND tilematrixset = ? AND zoom = ?
+                    AND block_row = ? AND block_col = ? AND owner = ? AND done = 0''', (*self.lease, self.owner))
+
+            self.lease = None
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                if not self.lease:
+                    continue
+
+                try:
+                    cursor = self.connection.execute(
+                        '''UPDATE leases SET expires = ? WHERE layer = ? AND tilematrixset = ? AND zoom = ?
+                        AND block_row = ? AND block_col = ? AND owner = ?''', (time.time() + self.ttl, *self.lease, self.owner))
+                except sqlite3.OperationalError as error:
+                    print(f'{Fore.YELLOW}--> The lease could not be renewed ({error}){Style.RESET_ALL}')
+                    continue
+
+                # it expired before, and was taken by another process
+                if not cursor.rowcount:
+                    print(f'{Fore.YELLOW}--> The lease of the block (row {self.lease[3]}, col {self.lease[4]}) was lost, it may be downloaded twice{Style.RESET_ALL}')
+
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        self.release(False)
+        self.connection.close()
+
+
+def iter_leased_tiles(coordinator, manifest, tile_key, tiles, lease_size, finished_status):
+    '''
+    Yields the tiles of each block leased by the process, until all of them are done. A block is
+    marked as done when the next one is requested, and returned if the loop stops before.
+    While the blocks left are leased by other processes it waits, to take over the ones whose lease expires
+    '''
+
+    blocks = tiles.astype('int64') // lease_size
+
+    # the blocks in the order their first tile is requested, and the tiles grouped by block
+    (keys, first, inverse) = np.unique(blocks, axis=0, return_index=True, return_inverse=True)
+    rank = np.empty(len(keys), dtype='int64')
+    rank[np.argsort(first)] = np.arange(len(keys))
+    tile_rank = rank[inverse.reshape(-1)]
+
+    grouped = tiles[np.argsort(tile_rank, kind='stable')]
+    bounds = np.searchsorted(np.sort(tile_rank), np.arange(len(keys) + 1))
+    keys = [tuple(key) for key in keys[np.argsort(first)].tolist()]
+
+    # a new run of a finished job
+    coordinator.reset(tile_key)
+
+    while True:
+        index = coordinator.acquire(tile_key, keys)
+
+        if index is None:
+            next_expiry = coordinator.get_next_expiry(tile_key, keys)
+            if next_expiry is None:
+                return
+
+            # the blocks left are leased by others, and are taken over if their lease expires.
+            # Checked at least as often as the leases are renewed, to stop soon after they are done
+            delay = min(max(0, next_expiry - time.time()), coordinator.ttl / 3)
+
+            print(f'-> Waiting {delay:.0f}s for the blocks leased by other processes')
+            time.sleep(delay)
+            continue
+
+        (block_row, block_col) = keys[index]
+        block_tiles = grouped[bounds[index]:bounds[index + 1]]
+
+        # the tiles saved by a process that lost this block before finishing it
+        finished_tiles = manifest.get_tiles(*tile_key, status=finished_status,
+            min_row=block_row * lease_size, max_row=(block_row + 1) * lease_size - 1,
+            min_col=block_col * lease_size, max_col=(block_col + 1) * lease_size - 1)
+        block_tiles = subtract_tiles(block_tiles, finished_tiles)
+
+        print(f'-> Leased block {index + 1}/{len(keys)} (row {block_row}, col {block_col}): {len(block_tiles)} tiles')
+
+        completed = False
+        try:
+            yield block_tiles
+            completed = True
+        finally:
+            coordinator.release(completed)
+
+
+def import_existing_tiles(manifest, tile_key, folder, file_prefix, extension):
+    '''
+    Adds to the manifest the tiles downloaded by older versions of the script.
+    The folder is listed only once, and empty files are ignored
+    '''
+
+    if not os.path.exists(folder):
+        return 0
+
+    prefix = f'{file_prefix}_row-'
+    suffix = f'_zoom-{tile_key[2]}.{extension}'
+    imported = 0
+
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.startswith(prefix) or not entry.name.endswith(suffix):
+                continue
+
+            size = entry.stat().st_size
+            if not size:
+                continue
+
+            (row, col) = entry.name[len(prefix):-len(suffix)].split('_col-')
+
+            manifest.set_done(*tile_key, int(row), int(col), {'bytes': size})
+            imported += 1
+
+    manifest.commit()
+
+    return imported
@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import bisect
+import threading
+import collections
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# upper bounds (in seconds) of the histogram buckets, from a tile request to a whole card reprojection
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800)
+
+
+class Metrics:
+    '''
+    Counters and timers of the stages of a pipeline, shared by its threads. The time of each
+    stage is kept as a histogram, so the latencies can be compared, and the totals show whether
+    a run is waiting on the network, the disk or GDAL. It can be written periodically as JSON lines,
+    and served in the Prometheus text format
+    '''
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+
+        # stage -> [count, total seconds, count of each bucket]
+        self.stages = {}
+
+        self.last_log = (self.started, collections.Counter())
+        self.stopped = threading.Event()
+        self.log_thread = None
+        self.server = None
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, [0] * (len(buckets) + 1)]
+
+            histogram = self.stages[stage]
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2][bisect.bisect_left(buckets, seconds)] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def state(self):
+        '''
+        Copy of the counters and histograms, to be merged by another process
+        '''
+
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {stage: [count, total, list(counts)] for (stage, (count, total, counts)) in self.stages.items()}
+            }
+
+    def merge(self, state):
+        with self.lock:
+            self.counters.update(state['counters'])
+
+            for (stage, (count, total, counts)) in state['stages'].items():
+                if stage not in self.stages:
+                    self.stages[stage] = [0, 0.0, [0] * (len(buckets) + 1)]
+
+                histogram = self.stages[stage]
+                histogram[0] += count
+                histogram[1] += total
+                histogram[2] = [a + b for (a, b) in zip(histogram[2], counts)]
+
+    def snapshot(self):
+        '''
+        Counters, rates since the previous snapshot and summary of each stage. The percentiles
+        are the upper bound of the bucket where they fall
+        '''
+
+        now = time.time()
+
+        with self.lock:
+            (last_time, last_counters) = self.last_log
+            interval = max(now - last_time, 1e-9)
+
+            stages = {}
+            for (stage, (count, total, counts)) in self.stages.items():
+                stages[stage] = {
+                    'count': count,
+                    'seconds': round(total, 6),
+                    'mean': round(total / count, 6) if count else None,
+                    'p50': get_percentile(counts, count, 0.5),
+                    'p90': get_percentile(counts, count, 0.9),
+                    'p99': get_percentile(counts, count, 0.99)
+                }
+
+            snapshot = {
+                'time': round(now, 3),
+                'elapsed': round(now - self.started, 3),
+                'counters': dict(self.counters),
+                'rates': {f'{name}_per_second': round((value - last_counters[name]) / interval, 3) for (name, value) in self.counters.items()},
+                'stages': stages
+            }
+
+            self.last_log = (now, collections.Counter(self.counters))
+
+        return snapshot
+
+    def prometheus(self):
+        '''
+        Text exposition format, the counters as `<prefix>_<name>_total` and the stages
+        as the `<prefix>_stage_seconds` histogram
+        '''
+
+        lines = []
+
+        with self.lock:
+            for (name, value) in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+                lines.append(f'{self.prefix}_{name}_total {value}')
+
+            if self.stages:
+                lines.append(f'# TYPE {self.prefix}_stage_seconds histogram')
+
+            for (stage, (count, total, counts)) in sorted(self.stages.items()):
+                cumulative = 0
+                for (bound, bucket_count) in zip(buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{self.prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'{self.prefix}_stage_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'{self.prefix}_stage_seconds_count{{stage="{stage}"}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def start_log(self, path, interval=10):
+        '''
+        Appends a snapshot to a JSON lines file every `interval` seconds, and a last one when closed
+        '''
+
+        def write_log():
+            while not self.stopped.wait(interval):
+                self.write_log(path)
+
+        self.log_path = path
+        self.log_thread = threading.Thread(target=write_log, name='metrics-log', daemon=True)
+        self.log_thread.start()
+
+    def write_log(self, path):
+        with open(path, 'a') as file:
+            file.write(json.dumps(self.snapshot()) + '\n')
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+        Serves the metrics at `http://<host>:<port>/metrics` for Prometheus. Only on the local
+        interface by default, `host='0.0.0.0'` serves them to other machines too
+        '''
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.prometheus().encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+
+    def close(self):
+        self.stopped.set()
+
+        if self.log_thread:
+            self.log_thread.join()
+            self.write_log(self.log_path)
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def get_percentile(counts, count, quantile):
+    if not count:
+        return None
+
+    cumulative = 0
+    for (bound, bucket_count) in zip(buckets, counts):
+        cumulative += bucket_count
+        if cumulative >= count * quantile:
+            return bound
+
+    return '+Inf'
+
+
+def run_profiled(function, path=None):
+    '''
+    Runs the function, with cProfile if a path is given. The stats can be read with `pstats`
+    or snakeviz. It only profiles the main thread, the workers can be sampled with py-spy,
+    attaching to the process id printed here
+    '''
+
+    if not path:
+        return function()
+
+    import cProfile
+
+    print(f'-> Profiling to {path} (process id {os.getpid()}, e.g. `py-spy record --pid {os.getpid()}`)')
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        profiler.dump_stats(path)
@@ -0,0 +1,251 @@
+import math
+import json
+import warnings
+import numpy as np
+
+
+def plan_tiles(layer, zoom, bbox=None, aoi=None, order='row', exclude=None, shard=None, chunk_size=10000):
+    '''
+    Yields the (row, col) of the tiles of a zoom level of a `TileLayer`, inside the bbox and the
+    area of interest (a shapely geometry in the projection of the layer, see `load_aoi`) if given.
+    The tiles are planned at once as an array, leaving out the `exclude` array of (row, col)
+    (e.g. the tiles already in a manifest) and keeping the `shard` (index, count) if given,
+    and they are yielded by chunks in the `order`, so the consumer sets the pace
+    '''
+
+    tiles = plan_tile_array(layer.get_matrix(zoom), layer.get_tiles_range(zoom, bbox), aoi)
+
+    if exclude is not None:
+        tiles = subtract_tiles(tiles, exclude)
+
+    if shard:
+        tiles = tiles[get_shard_mask(tiles, *shard)]
+
+    yield from iter_tiles(order_tiles(tiles, order), chunk_size)
+
+
+def filter_row_cols_by_bbox(matrix, bbox):
+    
+    a = matrix.scaledenominator * 0.00028
+    e = matrix.scaledenominator * -0.00028
+
+    column_orig = math.floor((float(bbox[0]) - matrix.topleftcorner[0]) / (a * matrix.tilewidth))
+    row_orig = math.floor((float(bbox[1]) - matrix.topleftcorner[1]) / (e * matrix.tilewidth))
+
+    column_dest = math.floor((float(bbox[2]) - matrix.topleftcorner[0]) / (a * matrix.tilewidth))
+    row_dest = math.floor((float(bbox[3]) - matrix.topleftcorner[1]) / (e * matrix.tilewidth))
+
+    if (column_orig > column_dest):
+        t = column_orig
+        column_orig = column_dest
+        column_dest = t
+
+    if (row_orig > row_dest):
+        t = row_orig
+        row_orig = row_dest
+        row_dest = t
+
+    column_dest += 1
+    row_dest += 1
+
+    return (column_orig, column_dest, row_orig, row_dest)
+
+
+def load_aoi(path, proj):
+    '''
+    Union of the polygons of a GeoJSON file, in the projection of the tile matrix.
+    The file projection is read from its `crs` member, EPSG:4326 if it has none
+    '''
+
+    from pyproj import CRS, Transformer
+    from shapely.geometry import shape
+    from shapely.ops import transform, unary_union
+
+    with open(path, 'r') as file:
+        geojson = json.load(file)
+
+    features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+    geoms = [shape(feature['geometry'] if 'geometry' in feature else feature) for feature in features]
+
+    aoi = unary_union([geom if geom.is_valid else geom.buffer(0) for geom in geoms])
+
+    aoi_crs = CRS.from_user_input(geojson.get('crs', {}).get('properties', {}).get('name', 'EPSG:4326'))
+
+    if not aoi_crs.equals(CRS.from_user_input(proj)):
+        transformer = Transformer.from_crs(aoi_crs, proj, always_xy=True)
+
+        # deprecated in shapely 2, but the only way in shapely 1.8
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            aoi = transform(transformer.transform, aoi)
+
+    return aoi
+
+
+def plan_tile_array(matrix, tiles_range, aoi=None):
+    '''
+    Array of (row, col) of the tiles to download, row by row. Without `aoi` it is every tile
+    of the range, otherwise only the tiles intersecting its area. The area is clipped once
+    per row of tiles, the columns of a row are the ones covered by the parts of the clip
+    '''
+
+    (min_row, max_row, min_col, max_col) = tiles_range
+
+    if aoi is None:
+        rows = np.arange(min_row, max_row, dtype='int32')
+        cols = np.arange(min_col, max_col, dtype='int32')
+        return np.column_stack((np.repeat(rows, len(cols)), np.tile(cols, len(rows))))
+
+    from shapely.geometry import box
+
+    pixel_size = matrix.scaledenominator * 0.00028 # Each pixel is assumed to be 0.28mm
+    tile_width = matrix.tilewidth * pixel_size
+    tile_height = matrix.tileheight * pixel_size
+    (left, top) = matrix.topleftcorner
+
+    (aoi_left, aoi_bottom, aoi_right, aoi_top) = aoi.bounds
+
+    # only the rows crossed by the area
+    min_row = max(min_row, math.floor((top - aoi_top) / tile_height))
+    max_row = min(max_row, math.ceil((top - aoi_bottom) / tile_height))
+
+    rows_tiles = []
+
+    for row in range(min_row, max_row):
+        row_top = top - row * tile_height
+        clip = aoi.intersection(box(left + min_col * tile_width, row_top - tile_height, left + max_col * tile_width, row_top))
+
+        ranges = []
+
+        # a connected part covers every column between its bounds
+        for part in getattr(clip, 'geoms', [clip]):
+
+            # parts only touching the row edges have no area
+            if part.is_empty or not part.area:
+                continue
+
+            (part_left, _, part_right, _) = part.bounds
+            first_col = max(min_col, math.floor((part_left - left) / tile_width))
+            last_col = min(max_col, math.ceil((part_right - left) / tile_width))
+            ranges.append(np.arange(first_col, last_col, dtype='int32'))
+
+        if ranges:
+            cols = np.unique(np.concatenate(ranges))
+            rows_tiles.append(np.column_stack((np.full(len(cols), row, dtype='int32'), cols)))
+
+    if not rows_tiles:
+        return np.empty((0, 2), dtype='int32')
+
+    return np.concatenate(rows_tiles)
+
+
+def subtract_tiles(tiles, other_tiles):
+    '''
+    Tiles that are not in `other_tiles`
+    '''
+
+    return tiles[~contains_tiles(tiles, other_tiles)]
+
+
+def contains_tiles(tiles, other_tiles):
+    '''
+    Mask of the tiles that are in `other_tiles`. The other tiles are marked in a grid covering the
+    tiles range, or compared by a single integer key when that grid would be too sparse
+    '''
+
+    if not len(tiles) or not len(other_tiles):
+        return np.zeros(len(tiles), dtype=bool)
+
+    (min_row, min_col) = tiles.min(axis=0)
+    (height, width) = tiles.max(axis=0) - (min_row, min_col) + 1
+
+    rows = other_tiles[:, 0] - min_row
+    cols = other_tiles[:, 1] - min_col
+
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+    if int(height) * int(width) > 4 * len(tiles) + 1000000:
+        keys = (tiles[:, 0] - min_row).astype('int64') * width + (tiles[:, 1] - min_col)
+        other_keys = rows[inside].astype('int64') * width + cols[inside]
+        return np.isin(keys, other_keys)
+
+    grid = np.zeros((height, width), dtype=bool)
+    grid[rows[inside], cols[inside]] = True
+
+    return grid[tiles[:, 0] - min_row, tiles[:, 1] - min_col]
+
+
+def is_parent_matrix(parent, matrix):
+    '''
+    Whether each tile of `parent` covers exactly 2x2 tiles of `matrix`, as in the usual quadtree tile matrix sets
+    '''
+
+    return (parent.topleftcorner == matrix.topleftcorner
+        and parent.tilewidth == matrix.tilewidth
+        and parent.tileheight == matrix.tileheight
+        and math.isclose(parent.scaledenominator, matrix.scaledenominator * 2, rel_tol=1e-6))
+
+
+def order_tiles(tiles, order='row'):
+    '''
+    Sorts the tiles along a Hilbert curve so each chunk of requests covers a compact area.
+    The planner already returns them row by row
+    '''
+
+    if order == 'hilbert' and len(tiles):
+        origin = tiles.min(axis=0)
+        size = 1 << int((tiles.max(axis=0) - origin).max()).bit_length()
+        return tiles[np.argsort(get_hilbert_index(tiles[:, 1] - origin[1], tiles[:, 0] - origin[0], size), kind='stable')]
+
+    return tiles
+
+
+def get_hilbert_index(x, y, size):
+    '''
+    Distance along the Hilbert curve filling a `size` x `size` grid (a power of 2) of each x, y pair
+    '''
+
+    x = x.astype('int64')
+    y = y.astype('int64')
+    index = np.zeros(len(x), dtype='int64')
+
+    s = size // 2
+
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+
+        # rotate the quadrant
+        flip = ~ry & rx
+        x[flip] = size - 1 - x[flip]
+        y[flip] = size - 1 - y[flip]
+
+        swap = ~ry
+        (x[swap], y[swap]) = (y[swap], x[swap])
+
+        s //= 2
+
+    return index
+
+
+def iter_tiles(tiles, chunk_size=10000):
+    '''
+    Yields the (row, col) of the tiles, converting only a chunk at a time into python values
+    '''
+
+    for start in range(0, len(tiles), chunk_size):
+        for (row, col) in tiles[start:start + chunk_size].tolist():
+            yield (row, col)
+
+
+def get_shard_mask(tiles, index, count, block_size=16):
+    '''
+    Mask of the tiles in the shard `index` of `count`. The tiles are split in square blocks,
+    so each shard requests areas of close tiles, and the blocks are scattered with a hash,
+    so the shards get a similar share of any area of interest
+    '''
+
+    blocks = tiles.astype('int64') // block_size
+
+    return ((blocks[:, 0] * 73856093) ^ (blocks[:, 1] * 19349663)) % count == index
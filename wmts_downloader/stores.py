@@ -0,0 +1,610 @@
+import os
+import shutil
+import hashlib
+import sqlite3
+import warnings
+import threading
+
+from .capabilities import write_file
+
+# checksum -> whether the tile is fully transparent
+empty_checksums = {}
+
+
+class FileStore:
+    '''
+    Saves each tile as an image with its world file, in the zoom folder. The files are
+    written with a temporary name and renamed when complete, and they are synced to disk
+    in batches, when the manifest is about to mark them as done
+    '''
+
+    # the tiles with the same content are hard links to the same file
+    deduplicated = True
+
+    def __init__(self, folder, file_prefix, extension, matrix, zoom):
+        self.folder = folder
+        self.file_prefix = file_prefix
+        self.extension = extension
+        self.matrix = matrix
+        self.zoom = zoom
+        self.lock = threading.Lock()
+
+        # files renamed since the last sync
+        self.unsynced = []
+
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def receive(self, row, col, chunks):
+        '''
+        Writes the chunks of a response into a temporary file, returns its path, checksum and size
+        '''
+
+        part_path = f'{self.get_file_path(row, col)}.part'
+        checksum = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(part_path, 'wb') as file:
+                for chunk in chunks:
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+        except BaseException:
+            self.discard(part_path)
+            raise
+
+        return (part_path, checksum.hexdigest(), size)
+
+    def discard(self, part_path):
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    def write(self, row, col, img, checksum=None, original=None, empty=None):
+        file_path = self.get_file_path(row, col)
+
+        # already in a temporary file when it was received by chunks
+        if isinstance(img, str):
+            part_path = img
+        else:
+            part_path = f'{file_path}.part'
+            with open(part_path, 'wb') as file:
+                file.write(img)
+
+        # the same content as another tile is saved as a hard link to its file
+        if original:
+            link_path = f'{file_path}.link'
+
+            try:
+                if os.path.exists(link_path):
+                    os.remove(link_path)
+                os.link(self.get_file_path(*original), link_path)
+                os.replace(link_path, file_path)
+                self.discard(part_path)
+                part_path = None
+            except OSError:
+                # removed, or the file system has no hard links
+                pass
+
+        # replaced by renaming, so files linked to the old one don't change
+        if part_path:
+            os.replace(part_path, file_path)
+
+        # the world file goes after the image, so a tile never has only the world file
+        world_file_path = write_world_file(self.folder, self.get_file_name(row, col), self.extension, col, row, self.matrix)
+
+        with self.lock:
+            self.unsynced += [file_path, world_file_path]
+
+    def get_file_name(self, row, col):
+        return f'{self.file_prefix}_row-{row}_col-{col}_zoom-{self.zoom}'
+
+    def get_file_path(self, row, col):
+        return f'{self.folder}/{self.get_file_name(row, col)}.{self.extension}'
+
+    def clear(self):
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+
+    def flush(self):
+        '''
+        Syncs to disk the files written since the last call, a single sync per batch of tiles
+        instead of one per tile
+        '''
+
+        with self.lock:
+            (paths, self.unsynced) = (self.unsynced, [])
+
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        # the renames are in the folder, which can only be synced outside windows
+        if paths and os.name != 'nt':
+            fd = os.open(self.folder, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.flush()
+
+
+class SQLiteStore:
+    '''
+    Base for the single file stores. The workers queue the tiles, and these are
+    inserted in batches, each one inside a single transaction
+    '''
+
+    # every tile is saved with its own image
+    deduplicated = False
+
+    def __init__(self, path, batch_size=500):
+        # other processes may be writing the same file
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_size = batch_size
+
+    def write(self, row, col, img, checksum=None, original=None, empty=None):
+        with self.lock:
+            self.batch.append(self.to_record(row, col, img, checksum))
+            if len(self.batch) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.batch:
+            return
+        with self.connection:
+            self.insert(self.batch)
+        self.batch = []
+
+    def insert(self, records):
+        self.connection.executemany(self.insert_query, records)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class MBTilesStore(SQLiteStore):
+    '''
+    Saves all the zoom levels in a MBTiles file. Only works with the GoogleMapsCompatible grid (EPSG:3857),
+    the georeferencing is implicit in it. Each distinct image is saved once in the `images` table, and the
+    `map` table references it by checksum, with the `tiles` view joining both as the spec requires.
+    Files created by older versions keep their plain `tiles` table
+    https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+    '''
+
+    def __init__(self, path, layer, format, matrix, zoom):
+
+        if matrix.matrixwidth != 2 ** zoom or matrix.matrixheight != 2 ** zoom:
+            raise Exception('MBTiles only supports the EPSG:3857 (GoogleMapsCompatible) tile matrix set, use the `gpkg` store instead')
+
+        super().__init__(path)
+
+        self.zoom = zoom
+        self.insert_query = 'INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+            self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)')
+
+            tiles_type = self.connection.execute("SELECT type FROM sqlite_master WHERE name = 'tiles'").fetchone()
+            self.deduplicated = not tiles_type or tiles_type[0] == 'view'
+
+            if self.deduplicated:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)')
+                self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)')
+                self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)')
+                self.connection.execute('''
+                    CREATE VIEW IF NOT EXISTS tiles AS
+                    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data
+                    FROM map JOIN images ON images.tile_id = map.tile_id
+                ''')
+            else:
+                self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+
+            zooms = [zoom]
+            for (name,) in self.connection.execute("SELECT value FROM metadata WHERE name IN ('minzoom', 'maxzoom')"):
+                zooms.append(int(name))
+
+            extension = format.split('/')[-1]
+            bounds = layer.boundingBoxWGS84 or (-180, -85.0511, 180, 85.0511)
+
+            metadata = {
+                'name': layer.id,
+                'description': layer.abstract or '',
+                'format': 'jpg' if extension == 'jpeg' else extension,
+                'type': 'baselayer',
+                'version': '1.0',
+                'bounds': ','.join(str(value) for value in bounds),
+                'minzoom': str(min(zooms)),
+                'maxzoom': str(max(zooms))
+            }
+
+            self.connection.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', metadata.items())
+
+    def to_record(self, row, col, img, checksum=None):
+        # the rows are numbered from the bottom (TMS)
+        return (self.zoom, col, 2 ** self.zoom - 1 - row, img, checksum or hashlib.sha256(img).hexdigest())
+
+    def insert(self, records):
+        if not self.deduplicated:
+            self.connection.executemany(self.insert_query, (record[:4] for record in records))
+            return
+
+        self.connection.executemany('INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)',
+                                    ((img, tile_id) for (_, _, _, img, tile_id) in records))
+        self.connection.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)',
+                                    ((zoom, col, row, tile_id) for (zoom, col, row, _, tile_id) in records))
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.batch = []
+
+            if not self.deduplicated:
+                self.connection.execute('DELETE FROM tiles WHERE zoom_level = ?', (self.zoom,))
+                return
+
+            self.connection.execute('DELETE FROM map WHERE zoom_level = ?', (self.zoom,))
+            self.connection.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)')
+
+
+class GeoPackageStore(SQLiteStore):
+    '''
+    Saves all the zoom levels in a GeoPackage tiles table. The tile matrix is stored
+    in the `gpkg_tile_matrix` tables, so it can be read directly by GDAL/QGIS
+    http://www.geopackage.org/spec/#tiles
+    '''
+
+    def __init__(self, path, layer, proj, matrix, zoom):
+
+        super().__init__(path)
+
+        self.zoom = zoom
+        self.table = ''.join(char if char.isalnum() else '_' for char in layer.id)
+        self.insert_query = f'INSERT OR REPLACE INTO "{self.table}" (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+
+        pixel_size = matrix.scaledenominator * 0.00028 # Each pixel is assumed to be 0.28mm
+        self.matrix = matrix
+        self.tile_size = (matrix.tilewidth * pixel_size, matrix.tileheight * pixel_size)
+
+        min_x = matrix.topleftcorner[0]
+        max_y = matrix.topleftcorner[1]
+        max_x = min_x + matrix.matrixwidth * matrix.tilewidth * pixel_size
+        min_y = max_y - matrix.matrixheight * matrix.tileheight * pixel_size
+
+        srs_id = int(proj.split(':')[-1])
+
+        with self.connection:
+            self.connection.execute('PRAGMA application_id = 1196444487') # GPKG
+            self.connection.execute('PRAGMA user_version = 10200')
+
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+                    srs_name TEXT NOT NULL,
+                    srs_id INTEGER PRIMARY KEY,
+                    organization TEXT NOT NULL,
+                    organization_coordsys_id INTEGER NOT NULL,
+                    definition TEXT NOT NULL,
+                    description TEXT
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS gpkg_contents (
+                    table_name TEXT NOT NULL PRIMARY KEY,
+                    data_type TEXT NOT NULL,
+                    identifier TEXT UNIQUE,
+                    description TEXT DEFAULT '',
+                    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+                    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,
+                    srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix_set (
+                    table_name TEXT NOT NULL PRIMARY KEY REFERENCES gpkg_contents(table_name),
+                    srs_id INTEGER NOT NULL REFERENCES gpkg_spatial_ref_sys (srs_id),
+                    min_x DOUBLE NOT NULL, min_y DOUBLE NOT NULL, max_x DOUBLE NOT NULL, max_y DOUBLE NOT NULL
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS gpkg_tile_matrix (
+                    table_name TEXT NOT NULL REFERENCES gpkg_contents(table_name),
+                    zoom_level INTEGER NOT NULL,
+                    matrix_width INTEGER NOT NULL,
+                    matrix_height INTEGER NOT NULL,
+                    tile_width INTEGER NOT NULL,
+                    tile_height INTEGER NOT NULL,
+                    pixel_x_size DOUBLE NOT NULL,
+                    pixel_y_size DOUBLE NOT NULL,
+                    PRIMARY KEY (table_name, zoom_level)
+                )
+            ''')
+            self.connection.execute(f'''
+                CREATE TABLE IF NOT EXISTS "{self.table}" (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    tile_data BLOB NOT NULL,
+                    UNIQUE (zoom_level, tile_column, tile_row)
+                )
+            ''')
+
+            # required by the spec
+            self.connection.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+                ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', None),
+                ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', None)
+            ])
+
+            self.connection.execute('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                                    (proj, srs_id, 'EPSG', srs_id, get_crs_wkt(proj), None))
+
+            # the extent is filled with the downloaded tiles when closing
+            self.connection.execute(
+                'INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier, description, srs_id) VALUES (?, ?, ?, ?, ?)',
+                (self.table, 'tiles', layer.id, layer.abstract or '', srs_id))
+
+            self.connection.execute('INSERT OR IGNORE INTO gpkg_tile_matrix_set VALUES (?, ?, ?, ?, ?, ?)',
+                                    (self.table, srs_id, min_x, min_y, max_x, max_y))
+
+            self.connection.execute('INSERT OR REPLACE INTO gpkg_tile_matrix VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (self.table, zoom, matrix.matrixwidth, matrix.matrixheight, matrix.tilewidth,
+                                     matrix.tileheight, pixel_size, pixel_size))
+
+    def to_record(self, row, col, img, checksum=None):
+        return (self.zoom, col, row, img)
+
+    def close(self):
+        self.flush()
+
+        (min_col, max_col, min_row, max_row) = self.connection.execute(
+            f'SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row) FROM "{self.table}" WHERE zoom_level = ?',
+            (self.zoom,)).fetchone()
+
+        if min_col is not None:
+            (left, top) = self.matrix.topleftcorner
+            extent = (
+                left + min_col * self.tile_size[0],
+                top - (max_row + 1) * self.tile_size[1],
+                left + (max_col + 1) * self.tile_size[0],
+                top - min_row * self.tile_size[1]
+            )
+
+            with self.connection:
+                self.connection.execute(
+                    '''UPDATE gpkg_contents SET
+                    min_x = MIN(COALESCE(min_x, ?), ?), min_y = MIN(COALESCE(min_y, ?), ?),
+                    max_x = MAX(COALESCE(max_x, ?), ?), max_y = MAX(COALESCE(max_y, ?), ?),
+                    last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now')
+                    WHERE table_name = ?''',
+                    (extent[0], extent[0], extent[1], extent[1], extent[2], extent[2], extent[3], extent[3], self.table))
+
+        self.connection.close()
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.batch = []
+            self.connection.execute(f'DELETE FROM "{self.table}" WHERE zoom_level = ?', (self.zoom,))
+
+
+class CogStore:
+    '''
+    Writes the tiles straight into a tiled and compressed GeoTIFF covering the requested extent.
+    The blocks have the size of the tiles and are aligned with them, so each tile is decoded
+    and written into its own block without keeping the mosaic in memory. When all the tiles
+    are downloaded the mosaic is converted to a Cloud Optimized GeoTIFF with overviews
+    '''
+
+    deduplicated = False
+
+    def __init__(self, path, proj, matrix, tiles_range, remove_old=False):
+
+        import rasterio
+        from rasterio.transform import from_origin
+        from rasterio.errors import NotGeoreferencedWarning
+
+        # the tiles are decoded without their world file
+        warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
+
+        self.rasterio = rasterio
+        self.path = path
+        self.work_path = f'{path[:-4]}.tmp.tif'
+        self.lock = threading.Lock()
+        self.matrix = matrix
+
+        (self.min_row, max_row, self.min_col, max_col) = tiles_range
+
+        pixel_size = matrix.scaledenominator * 0.00028 # Each pixel is assumed to be 0.28mm
+        left = matrix.topleftcorner[0] + self.min_col * matrix.tilewidth * pixel_size
+        top = matrix.topleftcorner[1] - self.min_row * matrix.tileheight * pixel_size
+
+        self.profile = {
+            'driver': 'GTiff',
+            'width': (max_col - self.min_col) * matrix.tilewidth,
+            'height': (max_row - self.min_row) * matrix.tileheight,
+            'count': 4,
+            'dtype': 'uint8',
+            'crs': proj,
+            'transform': from_origin(left, top, pixel_size, pixel_size),
+            'tiled': True,
+            'blockxsize': matrix.tilewidth,
+            'blockysize': matrix.tileheight,
+            'compress': 'DEFLATE',
+            'predictor': 2,
+            'photometric': 'RGB',
+            'alpha': 'YES',
+            'sparse_ok': True,
+            'bigtiff': 'IF_SAFER'
+        }
+
+        if remove_old:
+            self.clear()
+
+        self.created = not os.path.exists(self.work_path)
+
+        if not self.created:
+            with rasterio.open(self.work_path) as dataset:
+                if dataset.shape != (self.profile['height'], self.profile['width']) or not dataset.transform.almost_equals(self.profile['transform']):
+                    raise Exception(f'{self.work_path} was started with another extent, use the same bbox or `--removeold`')
+
+        if self.created:
+            self.dataset = rasterio.open(self.work_path, 'w', **self.profile)
+        else:
+            self.dataset = rasterio.open(self.work_path, 'r+')
+
+    def write(self, row, col, img, checksum=None, original=None, empty=None):
+        # the blocks of blank tiles are left sparse
+        if empty:
+            return
+
+        # decoded by the worker, only the write is serialized
+        data = decode_tile(img)
+
+        window = ((row - self.min_row) * self.matrix.tileheight, (col - self.min_col) * self.matrix.tilewidth)
+
+        with self.lock:
+            self.dataset.write(data, window=((window[0], window[0] + data.shape[1]), (window[1], window[1] + data.shape[2])))
+
+    def flush(self):
+        # closing is the only way to make GDAL write everything to disk
+        with self.lock:
+            self.dataset.close()
+            self.dataset = self.rasterio.open(self.work_path, 'r+')
+
+    def clear(self):
+        for path in (self.work_path, self.path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        with self.lock:
+            self.dataset.close()
+
+    def finalize(self):
+        from rasterio.shutil import copy
+
+        copy(self.work_path, self.path, driver='COG', compress='DEFLATE', predictor=2, blocksize=512,
+             overview_resampling='AVERAGE', num_threads='ALL_CPUS', bigtiff='IF_SAFER')
+
+        os.remove(self.work_path)
+
+
+def is_empty_tile(img, checksum):
+    '''
+    Whether the tile is fully transparent. Servers return the same bytes for every empty tile,
+    so each distinct tile is only decoded once
+    '''
+
+    if checksum not in empty_checksums:
+        from rasterio.errors import NotGeoreferencedWarning
+
+        # the tiles are decoded without their world file
+        warnings.filterwarnings('ignore', category=NotGeoreferencedWarning)
+
+        # received into a temporary file
+        if isinstance(img, str):
+            with open(img, 'rb') as file:
+                img = file.read()
+
+        try:
+            empty_checksums[checksum] = not decode_tile(img)[3].any()
+        except Exception:
+            empty_checksums[checksum] = False
+
+    return empty_checksums[checksum]
+
+
+def decode_tile(img):
+    '''
+    Decodes a tile into a RGBA array
+    '''
+
+    import numpy as np
+    from rasterio.io import MemoryFile
+
+    with MemoryFile(img) as memfile:
+        with memfile.open() as dataset:
+            data = dataset.read()
+
+            # paletted images
+            if dataset.count == 1:
+                try:
+                    colormap = dataset.colormap(1)
+                except ValueError:
+                    colormap = None
+
+                if colormap:
+                    lut = np.zeros((256, 4), dtype='uint8')
+                    for (index, color) in colormap.items():
+                        lut[index] = color
+                    return lut[data[0]].transpose(2, 0, 1)
+
+    opaque = np.full(data.shape[1:], 255, dtype='uint8')
+
+    if data.shape[0] == 1:
+        return np.stack([data[0], data[0], data[0], opaque])
+    if data.shape[0] == 2:
+        return np.stack([data[0], data[0], data[0], data[1]])
+    if data.shape[0] == 3:
+        return np.concatenate([data, opaque[np.newaxis]])
+
+    return data[:4]
+
+
+def get_crs_wkt(proj):
+    '''
+    WKT definition of the projection. Without rasterio it is left undefined, and readers rely on the EPSG code
+    '''
+
+    try:
+        from rasterio.crs import CRS
+        return CRS.from_string(proj).to_wkt()
+    except ImportError:
+        return 'undefined'
+
+
+def write_world_file(folder, file_name, extension, col, row, matrix):
+    '''
+    Writes world file
+    https://gdal.org/drivers/raster/wld.html
+    https://en.wikipedia.org/wiki/World_file
+    '''
+
+    if extension == 'png':
+        wf_ext = 'pgw'
+    elif extension == 'tiff' or extension == 'tiff':
+        wf_ext = 'tfw'
+    elif extension == 'jpg' or extension == 'jpeg':
+        wf_ext = 'jgw'
+    elif extension == 'gif':
+        wf_ext = 'gfw'
+    else:
+        wf_ext = 'wld'
+
+    pixel_size = 0.00028 # Each pixel is assumed to be 0.28mm
+    a = matrix.scaledenominator * pixel_size
+    e = matrix.scaledenominator * -pixel_size
+    left = ((col * matrix.tilewidth + 0.5) * a) + matrix.topleftcorner[0]
+    top = ((row * matrix.tileheight + 0.5) * e) + matrix.topleftcorner[1]
+
+    world_file_path = f'{folder}/{file_name}.{wf_ext}'
+
+    write_file(world_file_path, ('%f\n%d\n%d\n%f\n%f\n%f' % (a, 0, 0, e, left, top)).encode())
+
+    return world_file_path